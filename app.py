@@ -1,32 +1,1001 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, Response, g, has_app_context, has_request_context, stream_with_context
+from flask import abort, before_render_template, template_rendered
+from werkzeug.utils import safe_join
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from datetime import datetime, timedelta
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from markupsafe import Markup
+import base64
+import bisect
+import click
 import csv
+import hashlib
+import hmac
 import io
+import json
+import math
+import mimetypes
+import multiprocessing
+import os
+import queue
+import random
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+import urllib.parse
+
+import create_library_db
 
 app = Flask(__name__)
 app.secret_key = 'library_secret_key_change_this'
 
 DB = 'library.db'
 
-def get_db_connection():
-    conn = sqlite3.connect(DB)
-    conn.row_factory = sqlite3.Row
+# Connection pool settings. Any of these can be overridden from the
+# environment with a LIBRARY_ prefix, e.g. LIBRARY_DB_POOL_SIZE=16.
+app.config.update(
+    DB_POOL_SIZE=8,             # idle connections kept per process
+    DB_POOL_RECYCLE=3600,       # seconds before a connection is reopened
+    DB_POOL_MAX_USES=10000,     # checkouts before a connection is reopened
+    DB_SYNCHRONOUS='NORMAL',    # safe with WAL, avoids an fsync per commit
+    DB_CACHE_SIZE_KB=16384,     # page cache per connection
+    DB_MMAP_SIZE=256 * 1024 * 1024,
+    DB_BUSY_TIMEOUT_MS=5000,
+    DB_SHARED_CACHE=False,      # shared-cache mode; see ConnectionPool.connect
+    BRANCHES={},                # branch name -> database file; empty means one branch on DB
+    DEFAULT_BRANCH=None,        # branch for visitors who have not picked one; default: the first
+    BRANCH_WORKERS=8,           # threads that query branches in parallel for search and the dashboard
+    SEARCH_LIMIT=200,           # ranked results shown by /search
+    PAGE_SIZE=50,               # rows per page on list views
+    MAX_PAGE_SIZE=500,          # upper bound for ?per_page=
+    CSV_BATCH_SIZE=1000,        # rows fetched per batch by the CSV export
+    LOAN_DAYS=7,
+    PENALTY_PER_DAY=5.0,
+    PENALTY_GRACE_DAYS=0,       # days past due before a penalty starts
+    TXN_MAX_RETRIES=5,          # retries of a write transaction on SQLITE_BUSY
+    TXN_RETRY_DELAY=0.02,       # base backoff in seconds, doubled per retry
+    IMPORT_BATCH_SIZE=5000,     # rows per executemany/transaction in bulk imports
+    IMPORT_MAX_ERRORS=1000,     # rejected rows listed in an import report
+    CATALOG_CACHE_SIZE=512,     # rendered catalog pages kept per process
+    ANALYTICS_TOP_N=10,         # rows in each top-N table of the analytics report
+    PASSWORD_HASH_METHOD='scrypt:32768:8:1',  # werkzeug method; older hashes are upgraded at login
+    PASSWORD_WORKERS=2,         # processes that hash passwords; 0 hashes on the request thread
+    PASSWORD_QUEUE_LIMIT=8,     # hashes running or waiting before logins are refused with a 429
+    KIOSK_TOKENS={},            # bearer token -> desk name, for /api/kiosk/circulation
+    KIOSK_MAX_ITEMS=500,        # scans accepted in one kiosk batch
+    SUGGEST_LIMIT=10,           # default number of /api/suggest results
+    SUGGEST_MAX_LIMIT=50,       # upper bound for ?limit=
+    SUGGEST_PREBUILD=True,      # build a branch's /api/suggest index in the background when its pool opens
+    SLOW_QUERY_MS=200,          # statements slower than this are logged with their plan
+    REPORT_SNAPSHOT=True,       # serve reports from a periodically copied snapshot
+    REPORT_SNAPSHOT_PATH=None,  # default: <db name>-snapshot.db next to each branch's database
+    REPORT_SNAPSHOT_INTERVAL=300,   # seconds before a snapshot is refreshed
+    REPORT_SNAPSHOT_PAGES=1024,     # pages copied per backup step
+    REPORT_SNAPSHOT_SLEEP=0.005,    # pause between steps, in seconds
+    STATIC_MAX_AGE=365 * 24 * 3600, # cache lifetime of fingerprinted static URLs
+)
+app.config.from_prefixed_env('LIBRARY')
+
+
+class TimedCursor(sqlite3.Cursor):
+    """A cursor that charges its execute and fetch time to the current request."""
+
+    sql = None
+    params = ()
+    elapsed = 0.0
+    logged = False
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            took = time.perf_counter() - started
+            self.elapsed += took
+            if has_app_context():
+                g.sql_seconds = g.get('sql_seconds', 0.0) + took
+            if not self.logged and self.elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+                self.logged = True
+                log_slow_query(self.connection, self.sql, self.params, self.elapsed)
+
+    def execute(self, sql, params=()):
+        self.sql, self.params, self.elapsed, self.logged = sql, params, 0.0, False
+        if has_app_context():
+            g.sql_statements = g.get('sql_statements', 0) + 1
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self.sql, self.params, self.elapsed, self.logged = sql, None, 0.0, False
+        if has_app_context():
+            g.sql_statements = g.get('sql_statements', 0) + 1
+        return self._timed(super().executemany, sql, seq_of_params)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+
+class TimedConnection(sqlite3.Connection):
+    """A connection whose statements are all run through TimedCursor."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # sqlite3's own shortcuts bypass cursor(); route them through it so
+    # every statement a route runs is timed.
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+class PooledConnection(TimedConnection):
+    """A connection that goes back to its pool when a route calls close()."""
+
+    pool = None         # set only while the connection is checked out
+    created_at = 0.0
+    uses = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+
+    def really_close(self):
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """Keeps tuned SQLite connections open across requests.
+
+    Connections are configured once when they are opened (WAL, synchronous,
+    cache and mmap sizes, busy timeout) and then handed out again and again.
+    A connection is reopened after ``recycle`` seconds or ``max_uses``
+    checkouts so long-lived processes pick up a fresh page cache and file
+    handle now and then.
+    """
+
+    def __init__(self, path, size=8, recycle=3600, max_uses=10000, synchronous='NORMAL',
+                 cache_size_kb=16384, mmap_size=0, busy_timeout_ms=5000, shared_cache=False):
+        self.path = path
+        self.size = size
+        self.recycle = recycle
+        self.max_uses = max_uses
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.shared_cache = shared_cache
+        self.on_connect = []   # callables run on every new connection
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._wal_checked = False
+
+    @classmethod
+    def from_config(cls, path, config):
+        return cls(path,
+                   size=config['DB_POOL_SIZE'],
+                   recycle=config['DB_POOL_RECYCLE'],
+                   max_uses=config['DB_POOL_MAX_USES'],
+                   synchronous=config['DB_SYNCHRONOUS'],
+                   cache_size_kb=config['DB_CACHE_SIZE_KB'],
+                   mmap_size=config['DB_MMAP_SIZE'],
+                   busy_timeout_ms=config['DB_BUSY_TIMEOUT_MS'],
+                   shared_cache=config['DB_SHARED_CACHE'])
+
+    def connect(self):
+        # Shared-cache mode is off by default: SQLite discourages it and it
+        # swaps WAL's readers-never-block-writers for table-level locks.
+        # With WAL every connection already shares the OS page cache and
+        # the mmap'd file.
+        if self.shared_cache:
+            conn = sqlite3.connect(f'file:{self.path}?cache=shared', uri=True,
+                                   factory=PooledConnection, check_same_thread=False,
+                                   timeout=self.busy_timeout_ms / 1000)
+        else:
+            conn = sqlite3.connect(self.path, factory=PooledConnection, check_same_thread=False,
+                                   timeout=self.busy_timeout_ms / 1000)
+        conn.row_factory = sqlite3.Row
+        with self._lock:
+            if not self._wal_checked:
+                # journal_mode is stored in the database file, so it only
+                # needs to be switched once; switching takes a write lock.
+                if conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+                    conn.execute('PRAGMA journal_mode = WAL')
+                self._wal_checked = True
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.created_at = time.monotonic()
+        for hook in self.on_connect:
+            hook(conn)
+        return conn
+
+    def _expired(self, conn):
+        return (time.monotonic() - conn.created_at > self.recycle
+                or conn.uses >= self.max_uses)
+
+    def acquire(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+                break
+            if not self._expired(conn):
+                break
+            conn.really_close()
+        with self._lock:
+            conn.pool = self
+            conn.uses += 1
+        return conn
+
+    def release(self, conn, checkout=None):
+        with self._lock:
+            if conn.pool is not self or (checkout is not None and conn.uses != checkout):
+                return  # already released, possibly handed out again since
+            conn.pool = None
+        if conn.in_transaction:
+            conn.rollback()
+        if self._expired(conn) or self._idle.qsize() >= self.size:
+            conn.really_close()
+            return
+        self._idle.put(conn)
+
+    def idle_count(self):
+        return self._idle.qsize()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().really_close()
+            except queue.Empty:
+                return
+
+
+def branch_databases():
+    """Branch name -> database file, in configured order."""
+    return app.config['BRANCHES'] or {'main': DB}
+
+
+def default_branch():
+    branches = branch_databases()
+    name = app.config['DEFAULT_BRANCH']
+    return name if name in branches else next(iter(branches))
+
+
+def current_branch():
+    """The branch this request works on (see select_branch), or the default outside a request."""
+    if has_app_context() and 'branch' in g:
+        return g.branch
+    return default_branch()
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(branch=None):
+    """The connection pool of ``branch`` (default: the current one), migrating its database on first use."""
+    branch = branch or current_branch()
+    pool = _pools.get(branch)
+    if pool is None:
+        created = False
+        with _pool_lock:
+            pool = _pools.get(branch)
+            if pool is None:
+                pool = ConnectionPool.from_config(branch_databases()[branch], app.config)
+                conn = pool.acquire()
+                create_library_db.migrate(conn)
+                conn.close()
+                _pools[branch] = pool
+                created = True
+        if created and app.config['SUGGEST_PREBUILD']:
+            get_suggest_index(branch).refresh()
+    return pool
+
+
+def get_db_connection(branch=None):
+    conn = get_pool(branch).acquire()
+    # Remember what this request checked out so nothing leaks if a route
+    # raises before it gets to conn.close().
+    if has_app_context():
+        g.setdefault('db_connections', []).append((conn, conn.uses))
     return conn
 
+
+@app.after_request
+def note_streamed_response(response):
+    g.response_streamed = response.is_streamed
+    return response
+
+
+@app.teardown_appcontext
+def release_db_connections(exc):
+    # A streamed response (the CSV export) tears down twice: once when the
+    # view returns, before the body is generated, and again when
+    # stream_with_context finishes it. Only the second may release the
+    # connection the generator is still reading from.
+    if g.pop('response_streamed', False):
+        return
+    for conn, checkout in g.pop('db_connections', ()):
+        pool = conn.pool
+        if pool is not None:
+            pool.release(conn, checkout)
+    for conn in g.pop('report_connections', ()):
+        conn.close()
+
+
+class BranchPrefixMiddleware:
+    """Serve /branch/<name>/... as the same page of branch <name>.
+
+    The prefix moves from PATH_INFO to SCRIPT_NAME, so routes match as
+    usual and url_for() keeps every link inside the branch.
+    """
+
+    PREFIX = re.compile(r'^/branch/([^/]+)(/.*)?$')
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        m = self.PREFIX.match(environ.get('PATH_INFO', ''))
+        if m and m.group(1) in branch_databases():
+            base = environ.get('SCRIPT_NAME', '')
+            environ['library.base_path'] = base
+            environ['library.branch'] = m.group(1)
+            environ['SCRIPT_NAME'] = f'{base}/branch/{m.group(1)}'
+            environ['PATH_INFO'] = m.group(2) or '/'
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = BranchPrefixMiddleware(app.wsgi_app)
+
+
+def branch_url(branch, path='/'):
+    """``path`` (as in request.full_path) under ``branch``'s URL prefix."""
+    base = request.environ.get('library.base_path', request.script_root)
+    return f'{base}/branch/{branch}{path}'
+
+
+@app.before_request
+def select_branch():
+    """Pick the branch for this request.
+
+    Signed-in users stay on the branch they signed in at, since the ids in
+    their session only mean something there. Visitors get the branch in
+    the URL prefix, else the one they picked, else the default.
+    """
+    branches = branch_databases()
+    requested = request.environ.get('library.branch')
+    if session.get('role'):
+        home = session.get('branch', default_branch())
+        if home not in branches:
+            session.clear()
+            flash("Your branch is no longer available. Please log in again.")
+            g.branch = default_branch()
+            return redirect(url_for('login'))
+        g.branch = home
+        if requested and requested != home:
+            flash(f"You are signed in at {home}; log out to use {requested}.")
+            return redirect(branch_url(home, request.full_path.rstrip('?')))
+        return None
+    picked = session.get('branch')
+    g.branch = requested or (picked if picked in branches else default_branch())
+    return None
+
+
+@app.context_processor
+def inject_branches():
+    branches = list(branch_databases())
+    return {'branch': current_branch(), 'branches': branches if len(branches) > 1 else []}
+
+
+_branch_executor = None
+
+
+def fan_out(work):
+    """Run ``work(branch)`` for every branch in parallel; returns {branch: result} in branch order.
+
+    ``work`` runs on a pool thread without the request context, so it must
+    name its branch when it connects and close what it opens.
+    """
+    global _branch_executor
+    names = list(branch_databases())
+    if len(names) == 1:
+        return {names[0]: work(names[0])}
+    if _branch_executor is None:
+        with _pool_lock:
+            if _branch_executor is None:
+                _branch_executor = ThreadPoolExecutor(app.config['BRANCH_WORKERS'], thread_name_prefix='branch')
+    futures = [(name, _branch_executor.submit(work, name)) for name in names]
+    return {name: future.result() for name, future in futures}
+
+
+class ReportSnapshot:
+    """A read-only copy of the database that the librarian reports read.
+
+    refresh() copies the live database with SQLite's online backup API, a
+    few pages per step with a pause in between, into a temporary file
+    that then replaces the snapshot. Long report queries and exports run
+    against the copy, so they never hold the live database while
+    checkouts are writing to it. Requests already reading the old file
+    keep it open until they finish.
+    """
+
+    # Each write to the live database restarts an incremental copy; after
+    # this many restarts the copy is done in one step instead.
+    MAX_RESTARTS = 3
+
+    class Restarted(Exception):
+        pass
+
+    def __init__(self, source, path, interval=300, pages=1024, sleep=0.005, busy_timeout_ms=5000):
+        self.source = source
+        self.path = path
+        self.interval = interval
+        self.pages = pages
+        self.sleep = sleep
+        self.busy_timeout_ms = busy_timeout_ms
+        self._refreshing = threading.Lock()
+
+    @classmethod
+    def from_config(cls, source, config, branch=None):
+        path = config['REPORT_SNAPSHOT_PATH']
+        if not path:
+            path = os.path.splitext(source)[0] + '-snapshot.db'
+        elif branch is not None and len(config['BRANCHES']) > 1:
+            root, ext = os.path.splitext(path)
+            path = f'{root}-{branch}{ext}'
+        return cls(source, path,
+                   interval=config['REPORT_SNAPSHOT_INTERVAL'],
+                   pages=config['REPORT_SNAPSHOT_PAGES'],
+                   sleep=config['REPORT_SNAPSHOT_SLEEP'],
+                   busy_timeout_ms=config['DB_BUSY_TIMEOUT_MS'])
+
+    def taken_at(self):
+        """When the current snapshot was completed, or None if there is none."""
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(self.path))
+        except OSError:
+            return None
+
+    def stale(self):
+        taken = self.taken_at()
+        return taken is None or (datetime.now() - taken).total_seconds() > self.interval
+
+    def refresh(self, wait=True):
+        """Replace the snapshot with a fresh copy.
+
+        Returns False without copying when ``wait`` is false and another
+        thread of this process is already refreshing.
+        """
+        if not self._refreshing.acquire(blocking=wait):
+            return False
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(self.path) + '.',
+                                       dir=os.path.dirname(os.path.abspath(self.path)))
+            os.close(fd)
+            try:
+                src = sqlite3.connect(self.source, timeout=self.busy_timeout_ms / 1000)
+                dst = sqlite3.connect(tmp)
+                try:
+                    self._copy(src, dst)
+                    # Readers open the snapshot read-only, which a
+                    # rollback-journal file allows without -wal/-shm files.
+                    dst.execute('PRAGMA journal_mode = DELETE')
+                finally:
+                    dst.close()
+                    src.close()
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        finally:
+            self._refreshing.release()
+        return True
+
+    def _copy(self, src, dst):
+        seen = {'remaining': None, 'restarts': 0}
+
+        def progress(status, remaining, total):
+            if seen['remaining'] is not None and remaining > seen['remaining']:
+                seen['restarts'] += 1
+                if seen['restarts'] > self.MAX_RESTARTS:
+                    raise self.Restarted
+            seen['remaining'] = remaining
+
+        try:
+            src.backup(dst, pages=self.pages, progress=progress, sleep=self.sleep)
+        except self.Restarted:
+            # Under WAL a single-step copy only holds a read transaction,
+            # so it does not block checkouts either; it just takes longer
+            # before anything else can use this connection.
+            src.backup(dst)
+
+    def connect(self, hooks=()):
+        uri = 'file:' + urllib.parse.quote(os.path.abspath(self.path)) + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, factory=TimedConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for hook in hooks:
+            hook(conn)
+        return conn
+
+
+_snapshots = {}
+
+
+def get_snapshot(branch=None):
+    branch = branch or current_branch()
+    snapshot = _snapshots.get(branch)
+    if snapshot is None:
+        with _pool_lock:
+            snapshot = _snapshots.get(branch)
+            if snapshot is None:
+                snapshot = _snapshots[branch] = ReportSnapshot.from_config(
+                    branch_databases()[branch], app.config, branch)
+    return snapshot
+
+
+def get_report_connection():
+    """A connection for report reads: the snapshot, or the live database if REPORT_SNAPSHOT is off.
+
+    A missing snapshot is taken before returning; a stale one is served
+    while a background thread replaces it.
+    """
+    if not app.config['REPORT_SNAPSHOT']:
+        return get_db_connection()
+    hooks = get_pool().on_connect  # migrates the live database before it is copied
+    snapshot = get_snapshot()
+    if snapshot.taken_at() is None:
+        snapshot.refresh()
+    elif snapshot.stale():
+        threading.Thread(target=snapshot.refresh, kwargs={'wait': False}, daemon=True).start()
+    conn = snapshot.connect(hooks)
+    if conn.execute('PRAGMA user_version').fetchone()[0] < len(create_library_db.MIGRATIONS):
+        # Copied before the last migration; the reports may need its tables.
+        conn.close()
+        snapshot.refresh()
+        conn = snapshot.connect(hooks)
+    if has_app_context():
+        g.setdefault('report_connections', []).append(conn)
+        g.report_taken_at = snapshot.taken_at()
+    return conn
+
+
+def log_slow_query(conn, sql, params, seconds):
+    plan = ''
+    if params is not None:
+        try:
+            # A plain cursor, so the EXPLAIN is not itself timed and counted.
+            cur = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = '\n'.join('    ' + row[3] for row in cur)
+        except sqlite3.Error:
+            pass
+    app.logger.warning('Slow query (%.0f ms) in %s: %s\n%s', seconds * 1000,
+                       request.endpoint if has_request_context() else '-', ' '.join(sql.split()), plan)
+    request_metrics.slow_queries += 1
+
+
+class Histogram:
+    """Cumulative bucket counts, as Prometheus expects them."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        running = 0
+        for bound, n in zip(self.buckets, self.counts):
+            running += n
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {running}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class RequestMetrics:
+    """Per-endpoint histograms of request, SQL and template time and statement counts.
+
+    Numbers are per process and count from process start; Prometheus
+    turns them into rates over whatever window the dashboard asks for.
+    """
+
+    SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    STATEMENTS = (1, 2, 5, 10, 20, 50, 100, 500, 1000)
+    SERIES = (
+        ('library_request_duration_seconds', 'Wall time per request.', SECONDS),
+        ('library_request_sql_seconds', 'Time spent executing and fetching SQL per request.', SECONDS),
+        ('library_request_template_seconds', 'Time spent rendering templates per request.', SECONDS),
+        ('library_request_sql_statements', 'SQL statements issued per request.', STATEMENTS),
+    )
+
+    def __init__(self):
+        self.slow_queries = 0
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, total, sql, template, statements):
+        with self._lock:
+            series = self._endpoints.get(endpoint)
+            if series is None:
+                series = self._endpoints[endpoint] = [Histogram(b) for _, _, b in self.SERIES]
+            for histogram, value in zip(series, (total, sql, template, statements)):
+                histogram.observe(value)
+
+    def render(self, extra=()):
+        """The Prometheus text exposition of every series, plus ``extra`` (name, help, type, value)."""
+        lines = []
+        with self._lock:
+            for i, (name, help_text, _) in enumerate(self.SERIES):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for endpoint, series in sorted(self._endpoints.items()):
+                    lines += series[i].lines(name, f'endpoint="{endpoint}"')
+            extra = [('library_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.',
+                      'counter', self.slow_queries), *extra]
+        for name, help_text, kind, value in extra:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.sql_seconds = 0.0
+    g.sql_statements = 0
+    g.template_seconds = 0.0
+    g.template_depth = 0
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    # Partials rendered from inside a view (the catalog table) nest; only
+    # the outermost render is timed so nothing is counted twice.
+    if g.get('template_depth', 0) == 0:
+        g.template_started = time.perf_counter()
+    g.template_depth = g.get('template_depth', 0) + 1
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+    g.template_depth = g.get('template_depth', 1) - 1
+    if g.template_depth == 0 and 'template_started' in g:
+        g.template_seconds += time.perf_counter() - g.template_started
+
+@app.teardown_request
+def record_request_metrics(exc):
+    # A streamed response (the CSV export) tears down twice: once when the
+    # view returns and again when stream_with_context finishes the body.
+    # Only the second one has seen its SQL; release_db_connections clears
+    # the flag after the first.
+    if g.get('response_streamed') or 'request_started' not in g:
+        return
+    request_metrics.observe(request.endpoint or 'unmatched', time.perf_counter() - g.pop('request_started'),
+                            g.sql_seconds, g.template_seconds, g.sql_statements)
+
+
+_static_fingerprints = {}
+
+def static_fingerprint(filename):
+    """A short content hash of a static file, recomputed when its mtime changes."""
+    path = safe_join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except (TypeError, OSError):
+        return None
+    cached = _static_fingerprints.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = _static_fingerprints[filename] = (mtime, hashlib.sha1(f.read()).hexdigest()[:12])
+    return cached[1]
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename=...) gets ?v=<content hash>, so a changed
+    # file gets a new URL and the old one can be cached for good.
+    if endpoint == 'static' and 'v' not in values:
+        fingerprint = static_fingerprint(values.get('filename'))
+        if fingerprint:
+            values['v'] = fingerprint
+
+# Variants written by build_static.py next to the originals, best first.
+STATIC_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+STATIC_IMAGE_FORMATS = [('image/avif', '.avif'), ('image/webp', '.webp')]
+
+def accepts_explicitly(accept, value):
+    """Whether ``value`` is named in an Accept header with q > 0; ``*/*`` and ``image/*`` do not count.
+
+    Browsers send wildcards for formats they cannot decode (Safari 14
+    lists ``image/*`` without supporting AVIF), so a variant is only
+    offered when the client asks for it by name.
+    """
+    return any(v.lower() == value and q > 0 for v, q in accept)
+
+def static_variant(path):
+    """The smallest prebuilt variant of ``path`` this client accepts: (path, content encoding, mimetype)."""
+    mtime = os.path.getmtime(path)
+    usable = lambda candidate: os.path.isfile(candidate) and os.path.getmtime(candidate) >= mtime
+    stem, ext = os.path.splitext(path)
+    if ext.lower() in ('.png', '.jpg', '.jpeg'):
+        for mimetype, suffix in STATIC_IMAGE_FORMATS:
+            if accepts_explicitly(request.accept_mimetypes, mimetype) and usable(stem + suffix):
+                return stem + suffix, None, mimetype
+        return path, None, None
+    for encoding, suffix in STATIC_ENCODINGS:
+        if accepts_explicitly(request.accept_encodings, encoding) and usable(path + suffix):
+            return path + suffix, encoding, mimetypes.guess_type(path)[0]
+    return path, None, None
+
+def send_static(filename):
+    """The static route: precompressed or re-encoded variants, long-lived when fingerprinted."""
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    fingerprinted = request.args.get('v') == static_fingerprint(filename)
+    variant, encoding, mimetype = static_variant(path)
+    response = send_file(variant, mimetype=mimetype, conditional=True,
+                         max_age=app.config['STATIC_MAX_AGE'] if fingerprinted else None)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept' if os.path.splitext(path)[1].lower() in ('.png', '.jpg', '.jpeg')
+                      else 'Accept-Encoding')
+    if fingerprinted:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = send_static
+
+
+class LRUCache:
+    """A thread-safe, size-bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+catalog_cache = LRUCache(app.config['CATALOG_CACHE_SIZE'])
+
+def catalog_version(conn):
+    return conn.execute('SELECT catalog_version FROM library_stats WHERE id = 1').fetchone()[0]
+
+def titles_version(conn):
+    return conn.execute('SELECT titles_version FROM library_stats WHERE id = 1').fetchone()[0]
+
+def history_version(conn, student_id):
+    row = conn.execute('SELECT history_version FROM students WHERE id = ?', (student_id,)).fetchone()
+    return row[0] if row else None
+
+def not_modified(*versions):
+    """A 304 response if the client already has this page as of ``versions``, else None.
+
+    The ETag is a hash of the data versions the page is built from, the
+    URL and who is logged in, so it only changes when the page would.
+    Call it before doing the page's real work; add_page_validators()
+    puts the same ETag on the full response. Pages with flashed messages
+    waiting are never validated, since the cached copy would not show them.
+    """
+    if request.method != 'GET' or session.get('_flashes'):
+        return None
+    viewer = (session.get('role'), session.get('user_id'), session.get('student_id'))
+    g.etag = hashlib.sha1(repr((current_branch(), request.full_path, viewer, versions)).encode()).hexdigest()
+    if g.etag in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(g.etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+@app.after_request
+def add_page_validators(response):
+    if 'etag' in g and response.status_code == 200:
+        response.set_etag(g.etag)
+        # Browsers may keep the page but must ask before reusing it.
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Cookie')
+    return response
+
+def available_books_table(conn, borrow_buttons=False, version=None):
+    """The rendered page of available books this request asks for.
+
+    Pages are cached under the current catalog_version, which triggers
+    bump on every write to books, so a hit is never older than the last
+    change and outdated entries simply age out of the LRU.
+    """
+    if version is None:
+        version = catalog_version(conn)
+    # The pager links are built under script_root, which differs between
+    # /branch/<name>/ and the session-chosen branch at /.
+    key = (current_branch(), request.script_root, request.endpoint, version,
+           request.args.get('after'), request.args.get('before'), page_size())
+    html = catalog_cache.get(key)
+    if html is None:
+        page = keyset_page(conn, 'SELECT * FROM books WHERE available = 1')
+        html = Markup(render_template('_catalog_table.html', books=page.rows, page=page,
+                                      borrow_buttons=borrow_buttons))
+        catalog_cache.put(key, html)
+    return html
+
 @app.route('/')
 def index():
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books WHERE available = 1').fetchall()
+    version = catalog_version(conn)
+    cached = not_modified(version)
+    if cached:
+        conn.close()
+        return cached
+    catalog = available_books_table(conn, version=version)
     conn.close()
-    return render_template('index.html', books=books)
+    return render_template('index.html', catalog=catalog)
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+_hasher = None
+_hasher_lock = threading.Lock()
+_hasher_state = {'in_flight': 0, 'rejected': 0}
+
+HASHER_BUSY_MESSAGE = "Too many sign-ins at once. Please try again in a moment."
+
+
+def get_hasher():
+    """The process pool that hashes passwords, or None when PASSWORD_WORKERS is 0."""
+    global _hasher
+    if _hasher is None and app.config['PASSWORD_WORKERS'] > 0:
+        with _pool_lock:
+            if _hasher is None:
+                # spawn, not fork: the parent has threads and open SQLite handles.
+                # Spawned workers re-import the main script, so it needs the
+                # usual ``if __name__ == '__main__'`` guard.
+                _hasher = ProcessPoolExecutor(app.config['PASSWORD_WORKERS'],
+                                              mp_context=multiprocessing.get_context('spawn'))
+    return _hasher
+
+
+def run_hasher(fn, *args):
+    """Run a werkzeug hash function off the request thread.
+
+    At most PASSWORD_QUEUE_LIMIT calls run or wait at once; past that this
+    raises PasswordHasherBusy straight away rather than letting a burst of
+    logins queue up behind each other.
+    """
+    global _hasher
+    with _hasher_lock:
+        if _hasher_state['in_flight'] >= app.config['PASSWORD_QUEUE_LIMIT']:
+            _hasher_state['rejected'] += 1
+            raise PasswordHasherBusy()
+        _hasher_state['in_flight'] += 1
+    try:
+        hasher = get_hasher()
+        if hasher is None:
+            return fn(*args)
+        try:
+            return hasher.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A worker died (e.g. the OOM killer); start a fresh pool next time.
+            with _pool_lock:
+                if _hasher is hasher:
+                    _hasher = None
+            raise
+    finally:
+        with _hasher_lock:
+            _hasher_state['in_flight'] -= 1
+
+
+def hash_password(password):
+    method = app.config['PASSWORD_HASH_METHOD']
+    return run_hasher(generate_password_hash, password, method)
+
+
+def verify_password(pw_hash, password):
+    return run_hasher(check_password_hash, pw_hash, password)
+
+
+def hash_method_prefix(method):
+    """The part before the first ``$`` that werkzeug writes for ``method``.
+
+    werkzeug writes the parameters it was given verbatim and fills in its
+    defaults for the rest: "scrypt" -> "scrypt:32768:8:1".
+    """
+    name, *params = method.split(':')
+    defaults = {'scrypt': [str(2 ** 15), '8', '1'],
+                'pbkdf2': ['sha256', str(DEFAULT_PBKDF2_ITERATIONS)]}.get(name, [])
+    return ':'.join([name] + params + defaults[len(params):])
+
+
+def password_needs_rehash(pw_hash):
+    """Whether ``pw_hash`` was made with another method or cost than PASSWORD_HASH_METHOD."""
+    return pw_hash.split('$', 1)[0] != hash_method_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+
+def upgrade_password_hash(user, password):
+    """Re-hash a librarian's password with the current settings after a good login.
+
+    Best effort: when the hashers are busy or the database is locked the
+    old hash stays and is upgraded at a later login.
+    """
+    if not password_needs_rehash(user['password']):
+        return
+    try:
+        pw_hash = hash_password(password)
+    except PasswordHasherBusy:
+        return
+    conn = get_db_connection()
+    try:
+        # Only if nobody changed the password in the meantime.
+        conn.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                     (pw_hash, user['id'], user['password']))
+        conn.commit()
+    except sqlite3.OperationalError as exc:
+        if not is_busy_error(exc):
+            raise
+    finally:
+        conn.close()
+
+
+def hasher_busy(template):
+    flash(HASHER_BUSY_MESSAGE)
+    return render_template(template), 429, {'Retry-After': '1'}
+
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         register_type = request.form.get('register_type')
-        conn = get_db_connection()
 
         if register_type == 'librarian':
             fullname = request.form['fullname']
@@ -35,10 +1004,13 @@ def register():
             
             if not username or not password or not fullname:
                 flash("All fields required for Librarian registration.")
-                conn.close()
                 return redirect(url_for('register'))
                 
-            pw_hash = generate_password_hash(password)
+            try:
+                pw_hash = hash_password(password)
+            except PasswordHasherBusy:
+                return hasher_busy('register.html')
+            conn = get_db_connection()
             try:
                 conn.execute('INSERT INTO users (fullname, username, password, role) VALUES (?, ?, ?, ?)',
                              (fullname, username, pw_hash, 'librarian'))
@@ -58,11 +1030,11 @@ def register():
 
             if not fullname or not student_number or not course:
                 flash("All fields required for student registration.")
-                conn.close()
                 return redirect(url_for('register'))
 
             lastname = fullname.split()[-1] if fullname.split() else ''
             
+            conn = get_db_connection()
             try:
                 conn.execute('INSERT INTO students (fullname, lastname, student_number, course) VALUES (?, ?, ?, ?)', 
                              (fullname, lastname, student_number, course))
@@ -93,10 +1065,17 @@ def login():
             user = conn.execute('SELECT * FROM users WHERE username = ? AND role = "librarian"', (username,)).fetchone()
             conn.close()
 
-            if user and check_password_hash(user['password'], password):
+            try:
+                valid = user is not None and verify_password(user['password'], password)
+            except PasswordHasherBusy:
+                return hasher_busy('login.html')
+
+            if valid:
+                upgrade_password_hash(user, password)
                 session['user_id'] = user['id']
                 session['username'] = user['username']
                 session['role'] = 'librarian'
+                session['branch'] = current_branch()
                 flash("Logged in successfully as Librarian.")
                 return redirect(url_for('librarian_dashboard'))
             else:
@@ -117,6 +1096,7 @@ def login():
                 session['student_id'] = student['id']
                 session['student_fullname'] = student['fullname']
                 session['role'] = 'student'
+                session['branch'] = current_branch()
                 flash(f"Welcome, {student['fullname']}!")
                 return redirect(url_for('student_dashboard'))
             else:
@@ -128,9 +1108,20 @@ def login():
 
     return render_template('login.html')
 
+@app.route('/branches', methods=['POST'])
+def choose_branch():
+    name = request.form.get('branch')
+    if session.get('role'):
+        flash("Log out to switch branches.")
+    elif name in branch_databases():
+        session['branch'] = name
+    # Back to the unprefixed site, where the choice applies.
+    return redirect(request.environ.get('library.base_path', request.script_root) + '/')
+
 @app.route('/logout')
 def logout():
     session.clear()
+    session['branch'] = current_branch()
     flash("Logged out.")
     return redirect(url_for('index'))
 
@@ -142,14 +1133,188 @@ def student_dashboard():
 
     student_id = session['student_id']
     conn = get_db_connection()
-    available = conn.execute('SELECT * FROM books WHERE available = 1').fetchall()
+    version = catalog_version(conn)
+    cached = not_modified(version, history_version(conn, student_id))
+    if cached:
+        conn.close()
+        return cached
+    catalog = available_books_table(conn, borrow_buttons=True, version=version)
     borrowed = conn.execute('''
         SELECT br.*, b.title, b.author FROM borrow_records br
         JOIN books b ON br.book_id = b.id
         WHERE br.student_id = ? AND br.return_date IS NULL
     ''', (student_id,)).fetchall() 
     conn.close()
-    return render_template('user_dashboard.html', available=available, borrowed=borrowed)
+    return render_template('user_dashboard.html', catalog=catalog, borrowed=borrowed)
+
+class CirculationError(Exception):
+    """A borrow or return that cannot go ahead; the message is shown to the user."""
+
+def is_busy_error(exc):
+    return isinstance(exc, sqlite3.OperationalError) and (
+        'locked' in str(exc) or 'busy' in str(exc))
+
+def run_transaction(conn, work):
+    """Run ``work(conn)`` in a BEGIN IMMEDIATE transaction and commit it.
+
+    IMMEDIATE takes the write lock up front, so whatever ``work`` reads
+    cannot change under it before it writes. If the lock cannot be had
+    within the busy timeout the whole transaction is retried with
+    jittered exponential backoff, up to TXN_MAX_RETRIES times.
+    """
+    retries = app.config['TXN_MAX_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(conn)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as exc:
+            if not is_busy_error(exc) or attempt == retries:
+                raise
+            if conn.in_transaction:
+                conn.rollback()
+            time.sleep(random.uniform(0, app.config['TXN_RETRY_DELAY'] * 2 ** attempt))
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_ts(dt):
+    """Seconds since the epoch for a naive datetime, matching the *_ts columns."""
+    return (dt - EPOCH) // timedelta(seconds=1)
+
+def from_ts(ts):
+    return EPOCH + timedelta(seconds=ts)
+
+def compute_penalty(due, returned):
+    days_late = (returned - due).days if returned > due else 0
+    return max(days_late - app.config['PENALTY_GRACE_DAYS'], 0) * app.config['PENALTY_PER_DAY']
+
+def accrue_penalties(conn, now=None):
+    """Bring the 'accruing' ledger rows of all open overdue loans up to date.
+
+    One set-based upsert over the open-loans-by-due-date index, using the
+    same rate and grace period as compute_penalty(). Call inside
+    run_transaction(); returns the number of ledger rows written.
+    """
+    now = now or datetime.now()
+    grace = app.config['PENALTY_GRACE_DAYS']
+    # Loans due after this have not run past the grace period yet.
+    cutoff = now - timedelta(days=grace + 1)
+    return conn.execute('''
+        INSERT INTO penalty_ledger (record_id, student_id, book_id, days_late, amount, status, updated_at)
+        SELECT id, student_id, book_id, days_late, MAX(days_late - :grace, 0) * :rate, 'accruing', :now
+        FROM (
+            SELECT id, student_id, book_id, (:now_ts - due_ts) / 86400 AS days_late
+            FROM borrow_records
+            WHERE return_date IS NULL AND due_ts <= :cutoff
+        )
+        WHERE days_late > :grace
+        ON CONFLICT (record_id) DO UPDATE SET
+            days_late = excluded.days_late, amount = excluded.amount, updated_at = excluded.updated_at
+        WHERE penalty_ledger.status = 'accruing'
+    ''', {'now': now.isoformat(), 'now_ts': to_ts(now), 'cutoff': to_ts(cutoff), 'grace': grace,
+          'rate': app.config['PENALTY_PER_DAY']}).rowcount
+
+@app.cli.command('accrue-penalties')
+def accrue_penalties_command():
+    """Update accruing penalties for overdue loans in every branch (run from cron, e.g. hourly)."""
+    for branch in branch_databases():
+        conn = get_db_connection(branch)
+        try:
+            written = run_transaction(conn, accrue_penalties)
+        finally:
+            conn.close()
+        click.echo(f"{branch}: updated {written} accruing penalties.")
+
+def checkout_book(conn, student_id, book_id, now=None):
+    """Lend ``book_id`` to ``student_id``; call inside run_transaction().
+
+    The conditional UPDATE is the claim: only one transaction can flip a
+    book from available to not, so two students can never hold the same
+    copy. Returns the new record's (id, title, due date).
+    """
+    now = now or datetime.now()
+    due = now + timedelta(days=app.config['LOAN_DAYS'])
+    if not conn.execute('UPDATE books SET available = 0 WHERE id = ? AND available = 1', (book_id,)).rowcount:
+        raise CirculationError("Book not available.")
+    cur = conn.execute('INSERT INTO borrow_records (student_id, book_id, borrow_date, due_date) VALUES (?, ?, ?, ?)',
+                       (student_id, book_id, now.isoformat(), due.isoformat()))
+    title = conn.execute('SELECT title FROM books WHERE id = ?', (book_id,)).fetchone()['title']
+    return cur.lastrowid, title, due
+
+def checkin_record(conn, record_id, student_id=None, now=None):
+    """Close an open loan and free its book; call inside run_transaction().
+
+    Pass ``student_id`` to only accept that student's own records.
+    Returns the penalty charged.
+    """
+    now = now or datetime.now()
+    sql, params = 'SELECT * FROM borrow_records WHERE id = ?', [record_id]
+    if student_id is not None:
+        sql += ' AND student_id = ?'
+        params.append(student_id)
+    rec = conn.execute(sql, params).fetchone()
+    if not rec:
+        raise CirculationError("Record not found.")
+    if rec['return_date']:
+        raise CirculationError("Already returned.")
+    penalty = compute_penalty(from_ts(rec['due_ts']), now)
+    conn.execute('UPDATE borrow_records SET return_date = ?, penalty = ? WHERE id = ?',
+                 (now.isoformat(), penalty, record_id))
+    conn.execute('UPDATE books SET available = 1 WHERE id = ?', (rec['book_id'],))
+    return penalty
+
+# The date forms SQLite's date functions read, as the app itself writes them.
+STORED_DATE = re.compile(r'\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?')
+
+def update_borrow_record(conn, record_id, return_date, penalty):
+    """Librarian edit of a record that keeps book availability consistent.
+
+    Closing an open loan frees the book; reopening a closed one claims it
+    again, which fails if the book is out on another loan meanwhile.
+    """
+    if return_date:
+        # return_ts and the daily rollups are derived from this text.
+        try:
+            if not STORED_DATE.fullmatch(return_date):
+                raise ValueError(return_date)
+            datetime.fromisoformat(return_date)
+        except ValueError:
+            raise CirculationError("Return date must be YYYY-MM-DD, optionally with a time.") from None
+    rec = conn.execute('SELECT * FROM borrow_records WHERE id = ?', (record_id,)).fetchone()
+    if not rec:
+        raise CirculationError("Record not found.")
+    if return_date and not rec['return_date']:
+        conn.execute('UPDATE books SET available = 1 WHERE id = ?', (rec['book_id'],))
+    elif not return_date and rec['return_date']:
+        if not conn.execute('UPDATE books SET available = 0 WHERE id = ? AND available = 1',
+                            (rec['book_id'],)).rowcount:
+            raise CirculationError("Cannot reopen: the book is out on another loan.")
+    conn.execute('UPDATE borrow_records SET return_date = ?, penalty = ? WHERE id = ?',
+                 (return_date, penalty, record_id))
+
+def delete_borrow_record(conn, record_id):
+    rec = conn.execute('SELECT * FROM borrow_records WHERE id = ?', (record_id,)).fetchone()
+    if rec and not rec['return_date']:
+        conn.execute('UPDATE books SET available = 1 WHERE id = ?', (rec['book_id'],))
+    conn.execute('DELETE FROM borrow_records WHERE id = ?', (record_id,))
+
+BUSY_MESSAGE = "The library system is busy. Please try again."
+
+@app.errorhandler(sqlite3.OperationalError)
+def database_busy(exc):
+    # Writes retry inside run_transaction(); this catches what cannot, such
+    # as a worker's first connection switching the file to WAL or running
+    # migrations while another process holds the write lock.
+    if not is_busy_error(exc):
+        raise exc
+    return Response(BUSY_MESSAGE, status=503, mimetype='text/plain', headers={'Retry-After': '1'})
 
 @app.route('/borrow/<int:book_id>', methods=['POST'])
 def borrow_book(book_id):
@@ -158,24 +1323,21 @@ def borrow_book(book_id):
         return redirect(url_for('login'))
 
     student_id = session['student_id'] 
-    borrow_date = datetime.now()
-    due_date = borrow_date + timedelta(days=7)
-
     conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ? AND available = 1', (book_id,)).fetchone()
-
-    if not book:
-        flash("Book not available.")
-        conn.close()
+    try:
+        _, title, _ = run_transaction(conn, lambda c: checkout_book(c, student_id, book_id))
+    except CirculationError as e:
+        flash(str(e))
         return redirect(url_for('student_dashboard'))
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        flash(BUSY_MESSAGE)
+        return redirect(url_for('student_dashboard'))
+    finally:
+        conn.close()
 
-    conn.execute('INSERT INTO borrow_records (student_id, book_id, borrow_date, due_date) VALUES (?, ?, ?, ?)',
-                 (student_id, book_id, borrow_date.isoformat(), due_date.isoformat())) 
-    conn.execute('UPDATE books SET available = 0 WHERE id = ?', (book_id,))
-    conn.commit()
-    conn.close()
-
-    flash(f"Book borrowed: {book['title']}. Due in 7 days.")
+    flash(f"Book borrowed: {title}. Due in {app.config['LOAN_DAYS']} days.")
     return redirect(url_for('student_dashboard'))
 
 @app.route('/return/<int:record_id>', methods=['POST'])
@@ -186,33 +1348,134 @@ def return_book(record_id):
 
     student_id = session['student_id'] 
     conn = get_db_connection()
-    rec = conn.execute('SELECT * FROM borrow_records WHERE id = ? AND student_id = ?', (record_id, student_id)).fetchone()
-    if not rec:
-        flash("Record not found.")
-        conn.close()
+    try:
+        penalty = run_transaction(conn, lambda c: checkin_record(c, record_id, student_id))
+    except CirculationError as e:
+        flash(str(e))
         return redirect(url_for('student_dashboard'))
-
-    if rec['return_date']:
-        flash("Already returned.")
-        conn.close()
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        flash(BUSY_MESSAGE)
         return redirect(url_for('student_dashboard'))
-
-    return_date = datetime.now()
-    due = datetime.fromisoformat(rec['due_date'])
-    penalty = 0
-    if return_date > due:
-        days_late = (return_date - due).days
-        penalty = days_late * 5.0
-
-    conn.execute('UPDATE borrow_records SET return_date = ?, penalty = ? WHERE id = ?',
-                 (return_date.isoformat(), penalty, record_id))
-    conn.execute('UPDATE books SET available = 1 WHERE id = ?', (rec['book_id'],))
-    conn.commit()
-    conn.close()
+    finally:
+        conn.close()
 
     flash(f"Book returned. Penalty ₱{penalty:.2f}")
     return redirect(url_for('student_dashboard'))
 
+def kiosk_desk():
+    """The desk name for the request's bearer token, or None if it matches no configured token."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    desk = None
+    # Compare against every token so the time taken does not say which one came close.
+    for candidate, name in app.config['KIOSK_TOKENS'].items():
+        if hmac.compare_digest(candidate.encode(), token.strip().encode()):
+            desk = name
+    return desk
+
+def kiosk_error(message, status):
+    return {'error': message}, status
+
+def resolve_students(conn, numbers):
+    """Map student numbers to student ids in one query."""
+    return dict(conn.execute(
+        'SELECT student_number, id FROM students WHERE student_number IN (SELECT value FROM json_each(?))',
+        (json.dumps(sorted(numbers)),)).fetchall())
+
+def kiosk_id(item, key):
+    value = item.get(key)
+    # bool is an int to Python but never a valid id.
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise CirculationError(f"{key} must be an integer.")
+    if not sqlite_scalar(value):
+        raise CirculationError(f"{key} is out of range.")
+    return value
+
+def kiosk_item(conn, item, default_student, students, now):
+    """Apply one scan from a kiosk batch; raises CirculationError before writing anything."""
+    action = item.get('action')
+    if action == 'checkout':
+        student = item.get('student_number', default_student)
+        if student is None:
+            raise CirculationError("A checkout needs a student_number.")
+        student_id = students.get(str(student))
+        if student_id is None:
+            raise CirculationError("Student not found.")
+        record_id, title, due = checkout_book(conn, student_id, kiosk_id(item, 'book_id'), now)
+        return {'record_id': record_id, 'title': title, 'due_date': due.isoformat()}
+    if action == 'return':
+        if 'record_id' in item:
+            record_id = kiosk_id(item, 'record_id')
+        else:
+            # A scanned book: return whichever loan currently has it out.
+            rec = conn.execute('SELECT id FROM borrow_records WHERE book_id = ? AND return_date IS NULL',
+                               (kiosk_id(item, 'book_id'),)).fetchone()
+            if not rec:
+                raise CirculationError("Book is not out on loan.")
+            record_id = rec['id']
+        # The book is at the desk, so it goes back whoever borrowed it.
+        return {'record_id': record_id, 'penalty': checkin_record(conn, record_id, now=now)}
+    raise CirculationError("Unknown action.")
+
+@app.route('/api/kiosk/circulation', methods=['POST'])
+def api_kiosk_circulation():
+    """Check out and return a batch of scanned books for a circulation desk.
+
+    Authenticated with ``Authorization: Bearer <token>`` against
+    KIOSK_TOKENS instead of a session. The body is
+    ``{"student_number": ..., "items": [...]}`` where each item is
+    ``{"action": "checkout", "book_id": ...}`` or
+    ``{"action": "return", "book_id" or "record_id": ...}``. A checkout
+    may carry its own student_number for desks serving several students
+    at once; returns need no student.
+    The whole batch is one transaction; an item that cannot go ahead is
+    reported in its result and does not stop the rest.
+    """
+    desk = kiosk_desk()
+    if desk is None:
+        response, status = kiosk_error("Invalid or missing kiosk token.", 401)
+        return response, status, {'WWW-Authenticate': 'Bearer'}
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('items'), list):
+        return kiosk_error("Expected a JSON object with an items list.", 400)
+    items = body['items']
+    if len(items) > app.config['KIOSK_MAX_ITEMS']:
+        return kiosk_error(f"At most {app.config['KIOSK_MAX_ITEMS']} items per batch.", 413)
+    if not all(isinstance(item, dict) for item in items):
+        return kiosk_error("Each item must be a JSON object.", 400)
+
+    default_student = body.get('student_number')
+    numbers = {str(n) for n in [default_student] + [i.get('student_number') for i in items] if n is not None}
+
+    def work(conn):
+        students = resolve_students(conn, numbers) if numbers else {}
+        now = datetime.now()
+        results = []
+        for item in items:
+            try:
+                result = kiosk_item(conn, item, default_student, students, now)
+            except CirculationError as e:
+                results.append({'ok': False, 'error': str(e)})
+            else:
+                results.append({'ok': True, **result})
+        return results
+
+    conn = get_db_connection()
+    try:
+        results = run_transaction(conn, work)
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        response, status = kiosk_error(BUSY_MESSAGE, 503)
+        return response, status, {'Retry-After': '1'}
+    finally:
+        conn.close()
+    done = sum(r['ok'] for r in results)
+    return {'desk': desk, 'processed': done, 'failed': len(results) - done, 'results': results}
+
 @app.route('/my_history')
 def my_history():
     if 'student_id' not in session:
@@ -221,38 +1484,388 @@ def my_history():
 
     student_id = session['student_id']
     conn = get_db_connection()
-    records = conn.execute('''
+    cached = not_modified(titles_version(conn), history_version(conn, student_id))
+    if cached:
+        conn.close()
+        return cached
+    page = keyset_page(conn, '''
         SELECT br.*, b.title, b.author FROM borrow_records br
         JOIN books b ON br.book_id = b.id
         WHERE br.student_id = ?
-        ORDER BY br.borrow_date DESC
-    ''', (student_id,)).fetchall() 
+    ''', (student_id,), key=('borrow_ts', 'id'), descending=True)
     conn.close()
-    return render_template('history.html', records=records)
+    return render_template('history.html', records=page.rows, page=page)
+
+Page = namedtuple('Page', 'rows prev_url next_url')
+
+SQLITE_INT_MIN, SQLITE_INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+def sqlite_scalar(value):
+    """Whether ``value`` is a string or a number SQLite can bind (ints past 64 bits overflow)."""
+    if isinstance(value, int):
+        return SQLITE_INT_MIN <= value <= SQLITE_INT_MAX
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return isinstance(value, str)
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token, width):
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != width:
+        return None
+    # Objects, lists, null and out-of-range numbers would fail at the SQLite bind.
+    if not all(sqlite_scalar(v) for v in values):
+        return None
+    return values
+
+def page_size():
+    size = request.args.get('per_page', type=int) or app.config['PAGE_SIZE']
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+def keyset_page(conn, query, params=(), key=('id',), descending=False):
+    """Fetch the page of ``query`` selected by the ?after= / ?before= cursor.
+
+    Rows are ordered by the ``key`` columns, which must be unique together
+    and come out of ``query`` under those names. Instead of OFFSET the next
+    page starts after the last key seen, so with an index on ``key`` every
+    page costs the same however deep the user goes.
+    """
+    size = page_size()
+    after = decode_cursor(request.args.get('after'), len(key))
+    before = decode_cursor(request.args.get('before'), len(key)) if after is None else None
+    forward = before is None
+    ascending = forward != descending
+    cols = ', '.join(key)
+    sql = f'SELECT * FROM ({query})'
+    args = list(params)
+    if after or before:
+        op = '>' if ascending else '<'
+        sql += f' WHERE ({cols}) {op} ({", ".join("?" * len(key))})'
+        args += after or before
+    direction = 'ASC' if ascending else 'DESC'
+    sql += ' ORDER BY ' + ', '.join(f'{k} {direction}' for k in key) + ' LIMIT ?'
+    args.append(size + 1)
+
+    rows = conn.execute(sql, args).fetchall()
+    more = len(rows) > size
+    rows = rows[:size]
+    if not forward:
+        rows.reverse()
+
+    def link(**cursor):
+        view_args = dict(request.view_args or {})
+        query_args = {k: v for k, v in request.args.items() if k not in ('after', 'before')}
+        return url_for(request.endpoint, **view_args, **query_args, **cursor)
+
+    has_prev = more if not forward else after is not None
+    has_next = more if forward else True
+    prev_url = link(before=encode_cursor(rows[0][k] for k in key)) if rows and has_prev else None
+    next_url = link(after=encode_cursor(rows[-1][k] for k in key)) if rows and has_next else None
+    return Page(rows, prev_url, next_url)
+
+def fts_match_query(q):
+    """Turn free text into an FTS5 query where every word is a prefix match.
+
+    Words are quoted so user input can never be parsed as FTS5 syntax.
+    Returns None when there is nothing to match on.
+    """
+    words = re.findall(r'\w+', q)
+    if not words:
+        return None
+    return ' '.join('"%s"*' % w for w in words)
+
+def search_books(conn, q, limit):
+    match = fts_match_query(q)
+    if match is not None:
+        try:
+            # bm25() ranks lower-is-better; a title hit counts double.
+            return conn.execute('''
+                SELECT b.*, bm25(books_fts, 2.0, 1.0) AS rank FROM books_fts
+                JOIN books b ON b.id = books_fts.rowid
+                WHERE books_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (match, limit)).fetchall()
+        except sqlite3.OperationalError:
+            pass  # no FTS5 in this SQLite build, or the index was never created
+    return conn.execute("SELECT *, 0 AS rank FROM books WHERE title LIKE ? OR author LIKE ? LIMIT ?",
+                        ('%'+q+'%', '%'+q+'%', limit)).fetchall()
+
+def branch_catalog_version(branch):
+    conn = get_db_connection(branch)
+    try:
+        return catalog_version(conn)
+    finally:
+        conn.close()
+
+def search_all_branches(q, limit):
+    """The best ``limit`` matches for ``q`` across every branch, each tagged with its branch."""
+    def work(branch):
+        conn = get_db_connection(branch)
+        try:
+            return [dict(row, branch=branch) for row in search_books(conn, q, limit)]
+        finally:
+            conn.close()
+    # bm25 scores from different files are not strictly comparable (each
+    # has its own word statistics) but are close enough to interleave.
+    results = [row for rows in fan_out(work).values() for row in rows]
+    results.sort(key=lambda row: row['rank'])
+    return results[:limit]
 
 @app.route('/search', methods=['GET', 'POST'])
 def search():
+    # The form submits with GET so result pages can be revalidated and
+    # bookmarked; POST still works for old links and scripts.
     results = []
-    q = ''
-    if request.method == 'POST':
-        q = request.form['keyword']
+    q = request.form.get('keyword', '') if request.method == 'POST' else request.args.get('keyword', '')
+    if q:
+        cached = not_modified(tuple(fan_out(branch_catalog_version).values()))
+        if cached:
+            return cached
+        results = search_all_branches(q, app.config['SEARCH_LIMIT'])
+    return render_template('search.html', books=results, q=q)
+
+def fold_tokens(text):
+    """Lower-cased words of ``text`` with accents stripped: 'Peñafrancia' -> ['penafrancia']."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    plain = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return re.findall(r'\w+', plain.casefold())
+
+class PrefixIndex:
+    """Sorted title/author words with their book ids, for typeahead suggestions.
+
+    A lookup is a bisect into the sorted word list plus a walk over the
+    words that share the prefix, so it never touches the database. Per
+    book only the folded words are kept, as one string
+    (" title words | author words"); callers fetch the display rows for
+    the few ids returned. Book ids live in compact int arrays, one per
+    distinct word.
+
+    ``version`` is the library_stats.titles_version the index reflects.
+    apply() keeps it current for this worker's own writes, and
+    ensure_current() rebuilds it once another worker's writes have moved
+    the version on.
+    """
+
+    # Books looked at per query before ranking; keeps one-letter prefixes cheap.
+    MAX_CANDIDATES = 200
+
+    def __init__(self, branch=None):
+        self.branch = branch
+        self.version = None
+        self._tokens = []
+        self._postings = []
+        self._books = {}
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+
+    @staticmethod
+    def folded(title, author):
+        return ' ' + ' '.join(fold_tokens(title)) + ' | ' + ' '.join(fold_tokens(author))
+
+    @staticmethod
+    def words(folded):
+        return set(folded.split()) - {'|'}
+
+    def build(self, rows, version):
+        """Replace the contents with ``rows`` of (id, title, author)."""
+        postings, books = {}, {}
+        for book_id, title, author in rows:
+            folded = books[book_id] = self.folded(title, author)
+            for token in self.words(folded):
+                ids = postings.get(token)
+                if ids is None:
+                    ids = postings[token] = array('q')
+                ids.append(book_id)
+        tokens = sorted(postings)
+        with self._lock:
+            self._tokens = tokens
+            self._postings = [postings[t] for t in tokens]
+            self._books = books
+            self.version = version
+
+    def _insert(self, book_id, title, author):
+        folded = self._books[book_id] = self.folded(title, author)
+        for token in self.words(folded):
+            i = bisect.bisect_left(self._tokens, token)
+            if i < len(self._tokens) and self._tokens[i] == token:
+                self._postings[i].append(book_id)
+            else:
+                self._tokens.insert(i, token)
+                self._postings.insert(i, array('q', [book_id]))
+
+    def _remove(self, book_id):
+        for token in self.words(self._books.pop(book_id)):
+            i = bisect.bisect_left(self._tokens, token)
+            ids = self._postings[i]
+            ids.remove(book_id)
+            if not ids:
+                del self._tokens[i]
+                del self._postings[i]
+
+    def apply(self, version, book_id, title=None, author=None):
+        """Record this worker's write to one book (no title means deleted) at ``version``.
+
+        Only applied when it is the very next version; otherwise another
+        worker wrote in between and the next ensure_current() rebuilds.
+        """
+        with self._lock:
+            if self.version is None or version != self.version + 1:
+                return
+            if book_id in self._books:
+                self._remove(book_id)
+            if title is not None:
+                self._insert(book_id, title, author)
+            self.version = version
+
+    def search(self, q, limit):
+        """Ids of up to ``limit`` books with a word starting with each word of ``q``, title hits first."""
+        terms = sorted(set(fold_tokens(q)), key=len, reverse=True)
+        if not terms:
+            return []
+        first, rest = terms[0], [' ' + t for t in terms[1:]]
+        candidates = {}
+        with self._lock:
+            i = bisect.bisect_left(self._tokens, first)
+            while (i < len(self._tokens) and self._tokens[i].startswith(first)
+                   and len(candidates) < self.MAX_CANDIDATES):
+                for book_id in self._postings[i][:self.MAX_CANDIDATES - len(candidates)]:
+                    candidates[book_id] = self._books[book_id]
+                i += 1
+        ranked = []
+        first = ' ' + first
+        for book_id, folded in candidates.items():
+            if rest and not all(t in folded for t in rest):
+                continue
+            bar = folded.index(' | ')
+            ranked.append((folded.find(first, 0, bar) < 0, bar, folded, book_id))
+        ranked.sort()
+        return [book_id for *_, book_id in ranked[:limit]]
+
+    def refresh(self):
+        """Rebuild from the database on a background thread, unless a rebuild is already running."""
+        if not self._building.acquire(blocking=False):
+            return
+        def rebuild():
+            try:
+                conn = get_db_connection(self.branch)
+                try:
+                    self.build(conn.execute('SELECT id, title, author FROM books'), titles_version(conn))
+                finally:
+                    conn.close()
+            finally:
+                self._building.release()
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def wait(self, timeout=-1):
+        """Block until no rebuild is running; False if ``timeout`` seconds pass first."""
+        if not self._building.acquire(timeout=timeout):
+            return False
+        self._building.release()
+        return True
+
+    def ensure_current(self, conn):
+        """Rebuild in the background if the index is missing or behind; returns whether it can answer.
+
+        A stale index keeps answering while the fresh one is built. Until the
+        first build finishes there is nothing to answer from, and a keystroke
+        request should not wait seconds for a large catalog to load.
+        """
+        if self.version != titles_version(conn):
+            self.refresh()
+        return self.version is not None
+
+    def stats(self):
+        with self._lock:
+            return {'books': len(self._books), 'tokens': len(self._tokens), 'version': self.version}
+
+_suggest_indexes = {}
+
+def get_suggest_index(branch=None):
+    branch = branch or current_branch()
+    index = _suggest_indexes.get(branch)
+    if index is None:
+        with _pool_lock:
+            index = _suggest_indexes.setdefault(branch, PrefixIndex(branch))
+    return index
+
+def record_book_change(conn, book_id, title=None, author=None):
+    """Tell the typeahead index about a write to ``book_id``; call before the commit."""
+    get_suggest_index().apply(titles_version(conn), book_id, title, author)
+
+@app.route('/api/suggest')
+def api_suggest():
+    q = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', type=int) or app.config['SUGGEST_LIMIT'],
+                       app.config['SUGGEST_MAX_LIMIT']))
+    results = []
+    if q:
         conn = get_db_connection()
-        results = conn.execute("SELECT * FROM books WHERE title LIKE ? OR author LIKE ?", ('%'+q+'%', '%'+q+'%')).fetchall()
+        try:
+            index = get_suggest_index()
+            # Empty until the index's first build is done.
+            ids = index.search(q, limit) if index.ensure_current(conn) else []
+            rows = {r['id']: r for r in conn.execute(
+                'SELECT id, title, author FROM books WHERE id IN (SELECT value FROM json_each(?))',
+                (json.dumps(ids),))}
+        finally:
+            conn.close()
+        results = [{'id': i, 'title': rows[i]['title'], 'author': rows[i]['author']} for i in ids if i in rows]
+    return {'q': q, 'results': results}
+
+BRANCH_STAT_COLUMNS = ('total_books', 'available_books', 'total_students', 'total_borrows',
+                       'currently_borrowed', 'outstanding_penalties')
+
+def branch_stats(branch):
+    conn = get_db_connection(branch)
+    try:
+        return conn.execute('SELECT * FROM library_stats WHERE id = 1').fetchone()
+    finally:
         conn.close()
-    return render_template('search.html', books=results, q=q)
 
 @app.route('/librarian') 
 def librarian_dashboard():
     if 'user_id' not in session or session.get('role') != 'librarian': 
         flash("Librarian login required.") 
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    total_books = conn.execute('SELECT COUNT(*) as c FROM books').fetchone()['c']
-    total_students = conn.execute('SELECT COUNT(*) as c FROM students').fetchone()['c']
-    total_borrows = conn.execute('SELECT COUNT(*) as c FROM borrow_records').fetchone()['c']
-    conn.close()
-    return render_template('admin_dashboard.html', total_books=total_books,
-                           total_students=total_students, total_borrows=total_borrows)
+    every = fan_out(branch_stats)
+    stats = every[current_branch()]
+    totals = {k: sum(row[k] for row in every.values()) for k in BRANCH_STAT_COLUMNS}
+    return render_template('admin_dashboard.html', total_books=stats['total_books'],
+                           available_books=stats['available_books'],
+                           total_students=stats['total_students'], total_borrows=stats['total_borrows'],
+                           cache=catalog_cache.stats(), branch_stats=every, branch_totals=totals)
+
+@app.route('/librarian/metrics')
+def librarian_metrics():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    cache = catalog_cache.stats()
+    body = request_metrics.render([
+        ('library_catalog_cache_hits_total', 'Catalog page cache hits.', 'counter', cache['hits']),
+        ('library_catalog_cache_misses_total', 'Catalog page cache misses.', 'counter', cache['misses']),
+        ('library_catalog_cache_pages', 'Rendered catalog pages held.', 'gauge', cache['size']),
+        ('library_db_pool_idle_connections', 'Idle pooled SQLite connections.', 'gauge',
+         sum(pool.idle_count() for pool in list(_pools.values()))),
+        ('library_suggest_index_books', 'Books in the typeahead indexes.', 'gauge',
+         sum(index.stats()['books'] for index in list(_suggest_indexes.values()))),
+        ('library_suggest_index_tokens', 'Distinct words in the typeahead indexes.', 'gauge',
+         sum(index.stats()['tokens'] for index in list(_suggest_indexes.values()))),
+        ('library_password_hashes_in_flight', 'Password hashes running or queued.', 'gauge',
+         _hasher_state['in_flight']),
+        ('library_password_hashes_rejected_total', 'Logins and registrations refused with a 429.', 'counter',
+         _hasher_state['rejected']),
+    ])
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 @app.route('/librarian/books') 
 def librarian_books():
@@ -260,9 +1873,9 @@ def librarian_books():
         flash("Librarian only.") 
         return redirect(url_for('login'))
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books').fetchall()
+    page = keyset_page(conn, 'SELECT * FROM books')
     conn.close()
-    return render_template('admin_books.html', books=books)
+    return render_template('admin_books.html', books=page.rows, page=page)
 
 @app.route('/librarian/books/add', methods=['POST']) 
 def librarian_add_book():
@@ -272,7 +1885,8 @@ def librarian_add_book():
     title = request.form['title']
     author = request.form['author']
     conn = get_db_connection()
-    conn.execute('INSERT INTO books (title, author, available) VALUES (?, ?, 1)', (title, author))
+    cur = conn.execute('INSERT INTO books (title, author, available) VALUES (?, ?, 1)', (title, author))
+    record_book_change(conn, cur.lastrowid, title, author)
     conn.commit()
     conn.close()
     flash("Book added.")
@@ -285,8 +1899,9 @@ def librarian_edit_book(id):
         return redirect(url_for('login'))
     conn = get_db_connection()
     if request.method == 'POST':
-        conn.execute('UPDATE books SET title = ?, author = ?, available = ? WHERE id = ?',
-                     (request.form['title'], request.form['author'], int(request.form.get('available',1)), id))
+        if conn.execute('UPDATE books SET title = ?, author = ?, available = ? WHERE id = ?',
+                        (request.form['title'], request.form['author'], int(request.form.get('available',1)), id)).rowcount:
+            record_book_change(conn, id, request.form['title'], request.form['author'])
         conn.commit()
         conn.close()
         flash("Book updated.")
@@ -301,7 +1916,8 @@ def librarian_delete_book(id):
         flash("Librarian only.") 
         return redirect(url_for('login'))
     conn = get_db_connection()
-    conn.execute('DELETE FROM books WHERE id = ?', (id,))
+    if conn.execute('DELETE FROM books WHERE id = ?', (id,)).rowcount:
+        record_book_change(conn, id)
     conn.commit()
     conn.close()
     flash("Book deleted.")
@@ -313,9 +1929,9 @@ def librarian_students():
         flash("Librarian only.") 
         return redirect(url_for('login'))
     conn = get_db_connection()
-    students = conn.execute('SELECT * FROM students').fetchall()
+    page = keyset_page(conn, 'SELECT * FROM students')
     conn.close()
-    return render_template('admin_students.html', students=students)
+    return render_template('admin_students.html', students=page.rows, page=page)
 
 @app.route('/librarian/students/add', methods=['POST']) 
 def librarian_add_student():
@@ -367,20 +1983,217 @@ def librarian_delete_student(id):
     flash("Student deleted.")
     return redirect(url_for('librarian_students')) 
 
+ImportReport = namedtuple('ImportReport', 'kind inserted errors error_count seconds')
+
+class ImportDecodeError(Exception):
+    """A line of an import file that is not valid UTF-8."""
+
+    def __init__(self, line_no, reason):
+        super().__init__(reason)
+        self.line_no = line_no
+
+def utf8_lines(binary):
+    """Decode a binary file line by line, so a bad byte is reported with its line number."""
+    for line_no, raw in enumerate(binary, 1):
+        try:
+            # A newline byte never occurs inside a multi-byte UTF-8 sequence,
+            # so splitting before decoding is safe.
+            yield raw.decode('utf-8-sig' if line_no == 1 else 'utf-8')
+        except UnicodeDecodeError as e:
+            raise ImportDecodeError(line_no, str(e)) from None
+
+def read_import_rows(lines, filename):
+    """Yield (line_no, row, error) for each record of a CSV or JSON Lines file.
+
+    ``lines`` comes from utf8_lines() and is read lazily, so files of any
+    size are parsed in constant memory. CSV files need a header row. A
+    line that is not UTF-8 is reported as an error and ends the file;
+    whatever came before it is still imported.
+    """
+    try:
+        if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+            for line_no, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as e:
+                    yield line_no, None, f"invalid JSON: {e}"
+                    continue
+                if isinstance(row, dict):
+                    yield line_no, row, None
+                else:
+                    yield line_no, None, "expected a JSON object"
+        else:
+            reader = csv.DictReader(lines)
+            for row in reader:
+                yield reader.line_num, row, None
+    except ImportDecodeError as e:
+        yield e.line_no, None, f"not UTF-8 encoded ({e}); the rest of the file was not read"
+
+def import_text(row, field):
+    """``row[field]`` as a string; numbers are accepted, JSON objects and arrays are not."""
+    value = row.get(field)
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        raise ValueError(f"{field} must be text, not a JSON {'object' if isinstance(value, dict) else 'array'}")
+    return str(value)
+
+def clean_book(row):
+    title = import_text(row, 'title').strip()
+    if not title:
+        raise ValueError("title is required")
+    return (title, import_text(row, 'author').strip())
+
+def clean_student(row):
+    fullname = ' '.join(import_text(row, 'fullname').split())
+    student_number = import_text(row, 'student_number').strip()
+    if not fullname or not student_number:
+        raise ValueError("fullname and student_number are required")
+    lastname = fullname.split()[-1]
+    return (fullname, lastname, student_number, import_text(row, 'course').strip())
+
+def insert_books(conn, batch):
+    conn.executemany('INSERT INTO books (title, author, available) VALUES (?, ?, 1)',
+                     (values for _, values in batch))
+    return len(batch), []
+
+def insert_students(conn, batch):
+    # Checked inside the write transaction, so nobody can register one of
+    # these numbers between the lookup and the insert.
+    numbers = json.dumps([values[2] for _, values in batch])
+    taken = {r[0] for r in conn.execute(
+        'SELECT student_number FROM students WHERE student_number IN (SELECT value FROM json_each(?))',
+        (numbers,))}
+    fresh = [values for _, values in batch if values[2] not in taken]
+    conn.executemany('INSERT INTO students (fullname, lastname, student_number, course) VALUES (?, ?, ?, ?)',
+                     fresh)
+    errors = [(line_no, f"student number {values[2]} is already registered")
+              for line_no, values in batch if values[2] in taken]
+    return len(fresh), errors
+
+IMPORTERS = {
+    'books': (clean_book, insert_books, lambda values: None),
+    'students': (clean_student, insert_students, lambda values: values[2]),
+}
+
+def import_rows(conn, kind, rows):
+    """Validate and insert ``rows`` from read_import_rows() in large batches.
+
+    Each batch of IMPORT_BATCH_SIZE rows goes in with one executemany()
+    inside one transaction. Rows that fail validation or repeat a key
+    already seen are skipped and reported with their line number; at most
+    IMPORT_MAX_ERRORS of them are kept in the report.
+    """
+    clean, insert, key = IMPORTERS[kind]
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    max_errors = app.config['IMPORT_MAX_ERRORS']
+    started = time.perf_counter()
+    inserted, errors, error_count = 0, [], 0
+    seen = set()
+    batch = []
+
+    def report(line_no, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < max_errors:
+            errors.append((line_no, message))
+
+    def flush():
+        nonlocal inserted
+        added, batch_errors = run_transaction(conn, lambda c: insert(c, batch))
+        inserted += added
+        for line_no, message in batch_errors:
+            report(line_no, message)
+        batch.clear()
+
+    for line_no, row, error in rows:
+        if error:
+            report(line_no, error)
+            continue
+        try:
+            values = clean(row)
+        except ValueError as e:
+            report(line_no, str(e))
+            continue
+        k = key(values)
+        if k is not None:
+            if k in seen:
+                report(line_no, f"duplicate of an earlier row ({k})")
+                continue
+            seen.add(k)
+        batch.append((line_no, values))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return ImportReport(kind, inserted, errors, error_count, time.perf_counter() - started)
+
+def import_upload(kind):
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash("Choose a CSV or JSON Lines file to import.")
+        return redirect(url_for('librarian_' + kind))
+    conn = get_db_connection()
+    try:
+        report = import_rows(conn, kind, read_import_rows(utf8_lines(upload.stream), upload.filename))
+    finally:
+        conn.close()
+    return render_template('admin_import_report.html', report=report)
+
+@app.route('/librarian/books/import', methods=['POST'])
+def librarian_import_books():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    return import_upload('books')
+
+@app.route('/librarian/students/import', methods=['POST'])
+def librarian_import_students():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    return import_upload('students')
+
+def run_import_command(kind, path):
+    with open(path, 'rb') as f:
+        conn = get_db_connection()
+        try:
+            report = import_rows(conn, kind, read_import_rows(utf8_lines(f), path))
+        finally:
+            conn.close()
+    for line_no, message in report.errors:
+        click.echo(f"line {line_no}: {message}", err=True)
+    click.echo(f"Imported {report.inserted} {kind} in {report.seconds:.2f}s "
+               f"({report.inserted / max(report.seconds, 1e-9):.0f} rows/s), "
+               f"{report.error_count} rows rejected.")
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_books_command(path):
+    """Bulk-load books from a CSV (title,author) or JSON Lines file."""
+    run_import_command('books', path)
+
+@app.cli.command('import-students')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_students_command(path):
+    """Bulk-load students from a CSV (fullname,student_number,course) or JSON Lines file."""
+    run_import_command('students', path)
+
 @app.route('/librarian/borrow_records') 
 def librarian_borrow_records():
     if session.get('role') != 'librarian': 
         flash("Librarian only.") 
         return redirect(url_for('login'))
     conn = get_db_connection()
-    records = conn.execute('''
+    page = keyset_page(conn, '''
         SELECT br.*, s.fullname, b.title FROM borrow_records br
-        JOIN students s ON br.student_id = s.id -- Changed from users u on user_id
+        JOIN students s ON br.student_id = s.id
         JOIN books b ON br.book_id = b.id
-        ORDER BY br.borrow_date DESC
-    ''').fetchall()
+    ''', key=('borrow_ts', 'id'), descending=True)
     conn.close()
-    return render_template('admin_borrow_records.html', records=records)
+    return render_template('admin_borrow_records.html', records=page.rows, page=page)
 
 @app.route('/librarian/borrow_records/edit/<int:id>', methods=['GET', 'POST']) 
 def librarian_edit_borrow(id):
@@ -389,15 +2202,15 @@ def librarian_edit_borrow(id):
         return redirect(url_for('login'))
     conn = get_db_connection()
     if request.method == 'POST':
-        return_date = request.form.get('return_date') or None
+        return_date = (request.form.get('return_date') or '').strip() or None
         penalty = float(request.form.get('penalty') or 0)
-        conn.execute('UPDATE borrow_records SET return_date = ?, penalty = ? WHERE id = ?', (return_date, penalty, id))
-        rec = conn.execute('SELECT * FROM borrow_records WHERE id = ?', (id,)).fetchone()
-        if return_date:
-            conn.execute('UPDATE books SET available = 1 WHERE id = ?', (rec['book_id'],))
-        conn.commit()
-        conn.close()
-        flash("Record updated.")
+        try:
+            run_transaction(conn, lambda c: update_borrow_record(c, id, return_date, penalty))
+            flash("Record updated.")
+        except CirculationError as e:
+            flash(str(e))
+        finally:
+            conn.close()
         return redirect(url_for('librarian_borrow_records')) 
     rec = conn.execute('SELECT br.*, s.fullname, b.title FROM borrow_records br JOIN students s ON br.student_id=s.id JOIN books b ON br.book_id=b.id WHERE br.id = ?', (id,)).fetchone() # Updated JOIN
     conn.close()
@@ -409,62 +2222,380 @@ def librarian_delete_borrow(id):
         flash("Librarian only.") 
         return redirect(url_for('login'))
     conn = get_db_connection()
-    rec = conn.execute('SELECT * FROM borrow_records WHERE id = ?', (id,)).fetchone()
-    if rec and not rec['return_date']:
-        conn.execute('UPDATE books SET available = 1 WHERE id = ?', (rec['book_id'],))
-    conn.execute('DELETE FROM borrow_records WHERE id = ?', (id,))
-    conn.commit()
+    run_transaction(conn, lambda c: delete_borrow_record(c, id))
     conn.close()
     flash("Borrow record deleted.")
     return redirect(url_for('librarian_borrow_records')) 
 
+# Multi-select actions from the librarian lists. Each is a list of
+# set-based statements over the selected ids (bound as a JSON array to
+# :ids), run in order in one transaction; the count reported is the last
+# statement's rowcount. The triggers keep library_stats, the penalty
+# ledger and the page versions in step, as they do for single edits.
+SELECTED = 'SELECT value FROM json_each(:ids)'
+OPEN_LOAN = 'SELECT 1 FROM borrow_records WHERE book_id = books.id AND return_date IS NULL'
+BULK_ACTIONS = {
+    'borrow_records': {
+        'return': ("Marked returned", [
+            f'UPDATE books SET available = 1 WHERE id IN '
+            f'(SELECT book_id FROM borrow_records WHERE id IN ({SELECTED}) AND return_date IS NULL)',
+            # Same charge as checkin_record()/compute_penalty().
+            f'UPDATE borrow_records SET return_date = :now,'
+            f' penalty = MAX((:now_ts - due_ts) / 86400 - :grace, 0) * :rate'
+            f' WHERE id IN ({SELECTED}) AND return_date IS NULL',
+        ]),
+        'waive': ("Penalties waived", [
+            f'UPDATE borrow_records SET penalty = 0'
+            f' WHERE id IN ({SELECTED}) AND return_date IS NOT NULL AND penalty > 0',
+        ]),
+        'set_penalty': ("Penalty set", [
+            f'UPDATE borrow_records SET penalty = :penalty WHERE id IN ({SELECTED}) AND return_date IS NOT NULL',
+        ]),
+        'delete': ("Deleted", [
+            f'UPDATE books SET available = 1 WHERE id IN '
+            f'(SELECT book_id FROM borrow_records WHERE id IN ({SELECTED}) AND return_date IS NULL)',
+            f'DELETE FROM borrow_records WHERE id IN ({SELECTED})',
+        ]),
+    },
+    'books': {
+        'unavailable': ("Marked unavailable", [
+            f'UPDATE books SET available = 0 WHERE id IN ({SELECTED}) AND available = 1',
+        ]),
+        'available': ("Marked available", [
+            f'UPDATE books SET available = 1 WHERE id IN ({SELECTED}) AND available = 0 AND NOT EXISTS ({OPEN_LOAN})',
+        ]),
+        'delete': ("Deleted", [
+            f'DELETE FROM books WHERE id IN ({SELECTED}) AND NOT EXISTS ({OPEN_LOAN})',
+        ]),
+    },
+    'students': {
+        'delete': ("Deleted", [
+            f'DELETE FROM students WHERE id IN ({SELECTED}) AND NOT EXISTS '
+            f'(SELECT 1 FROM borrow_records WHERE student_id = students.id AND return_date IS NULL)',
+        ]),
+    },
+}
+
+def selected_ids():
+    """Ids from the ``ids`` checkboxes, or pasted into an ``ids`` box separated by commas or spaces."""
+    ids = set()
+    for value in request.form.getlist('ids'):
+        # Plain 0-9 only: str.isdigit() also passes '²', which int() rejects.
+        ids.update(int(v) for v in re.split(r'[\s,]+', value) if re.fullmatch(r'\d+', v, re.ASCII))
+    return sorted(ids)
+
+def run_bulk_action(conn, kind, action, ids, penalty=0.0, now=None):
+    """Apply BULK_ACTIONS[kind][action] to ``ids``; call inside run_transaction()."""
+    now = now or datetime.now()
+    params = {'ids': json.dumps(ids), 'now': now.isoformat(), 'now_ts': to_ts(now), 'penalty': penalty,
+              'grace': app.config['PENALTY_GRACE_DAYS'], 'rate': app.config['PENALTY_PER_DAY']}
+    count = 0
+    for sql in BULK_ACTIONS[kind][action][1]:
+        count = conn.execute(sql, params).rowcount
+    return count
+
+def bulk_action(kind):
+    action = request.form.get('action')
+    ids = selected_ids()
+    if action not in BULK_ACTIONS[kind]:
+        flash("Choose an action.")
+        return redirect(url_for('librarian_' + kind))
+    if not ids:
+        flash("Select at least one row.")
+        return redirect(url_for('librarian_' + kind))
+    try:
+        penalty = float(request.form.get('penalty') or 0)
+    except ValueError:
+        penalty = None
+    # float() also takes '-500', 'inf' and 'nan', which would go straight
+    # into the ledger and library_stats.outstanding_penalties.
+    if penalty is None or not math.isfinite(penalty) or penalty < 0:
+        flash("Penalty must be a number, zero or more.")
+        return redirect(url_for('librarian_' + kind))
+    conn = get_db_connection()
+    try:
+        count = run_transaction(conn, lambda c: run_bulk_action(c, kind, action, ids, penalty))
+    except sqlite3.OperationalError as e:
+        if not is_busy_error(e):
+            raise
+        flash(BUSY_MESSAGE)
+        return redirect(url_for('librarian_' + kind))
+    finally:
+        conn.close()
+    message = f"{BULK_ACTIONS[kind][action][0]}: {count} of {len(ids)} selected."
+    if count < len(ids):
+        message += " The rest were already in that state or are tied to an open loan."
+    flash(message)
+    return redirect(url_for('librarian_' + kind))
+
+@app.route('/librarian/borrow_records/bulk', methods=['POST'])
+def librarian_bulk_borrow_records():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    return bulk_action('borrow_records')
+
+@app.route('/librarian/books/bulk', methods=['POST'])
+def librarian_bulk_books():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    return bulk_action('books')
+
+@app.route('/librarian/students/bulk', methods=['POST'])
+def librarian_bulk_students():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    return bulk_action('students')
+
 @app.route('/librarian/penalties') 
 def librarian_penalties():
     if session.get('role') != 'librarian':
         flash("Librarian only.") 
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    rows = conn.execute('''
-        SELECT br.*, s.fullname, b.title FROM borrow_records br
-        JOIN students s ON br.student_id = s.id -- Changed from users u on user_id
-        JOIN books b ON br.book_id = b.id
-        WHERE br.penalty > 0 AND (br.return_date IS NOT NULL)
-    ''').fetchall()
+    status = request.args.get('status', 'all')
+    where, params = '', ()
+    if status in ('accruing', 'settled'):
+        where, params = 'WHERE pl.status = ?', (status,)
+    conn = get_report_connection()
+    page = keyset_page(conn, f'''
+        SELECT pl.*, s.fullname, b.title FROM penalty_ledger pl
+        JOIN students s ON pl.student_id = s.id
+        JOIN books b ON pl.book_id = b.id
+        {where}
+    ''', params, key=('record_id',), descending=True)
     conn.close()
-    return render_template('admin_penalties.html', rows=rows)
+    return render_template('admin_penalties.html', rows=page.rows, page=page, status=status)
+
+@app.route('/librarian/penalties/accrue', methods=['POST'])
+def librarian_accrue_penalties():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    conn = get_db_connection()
+    try:
+        written = run_transaction(conn, accrue_penalties)
+    finally:
+        conn.close()
+    if app.config['REPORT_SNAPSHOT']:
+        get_snapshot().refresh()
+    flash(f"Updated {written} accruing penalties.")
+    return redirect(url_for('librarian_penalties', status='accruing'))
 
 @app.route('/librarian/reports') 
 def librarian_reports():
     if session.get('role') != 'librarian': 
         flash("Librarian only.") 
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    total_books = conn.execute('SELECT COUNT(*) c FROM books').fetchone()['c']
-    borrowed = conn.execute('SELECT COUNT(*) c FROM borrow_records WHERE return_date IS NULL').fetchone()['c']
-    returned = conn.execute('SELECT COUNT(*) c FROM borrow_records WHERE return_date IS NOT NULL').fetchone()['c']
+    conn = get_report_connection()
+    stats = conn.execute('SELECT * FROM library_stats WHERE id = 1').fetchone()
     conn.close()
-    return render_template('admin_reports.html', total_books=total_books, borrowed=borrowed, returned=returned)
+    return render_template('admin_reports.html', total_books=stats['total_books'],
+                           borrowed=stats['currently_borrowed'], returned=stats['returned'],
+                           penalties=stats['outstanding_penalties'])
+
+def parse_day(value):
+    """Parse an optional YYYY-MM-DD filter; raises ValueError on bad input."""
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+# Bucket format and default window (in buckets) for each analytics period.
+ANALYTICS_PERIODS = {
+    'day': ('%Y-%m-%d', 1, 30),
+    'week': ('%Y-W%W', 7, 26),
+    'month': ('%Y-%m', 31, 24),
+}
+
+def loan_summary(row):
+    """Average loan days and share of late returns from a rollup row."""
+    returns = row['returns'] or 0
+    return {
+        'avg_loan_days': row['loan_seconds'] / returns / 86400 if returns else None,
+        'overdue_rate': row['late_returns'] / returns if returns else None,
+    }
+
+@app.route('/librarian/reports/analytics')
+def librarian_analytics():
+    """Circulation trends and rankings, read only from the circulation_by_* rollups.
+
+    The rollups are kept current by triggers on borrow_records (see
+    create_library_db.py), so every query here is over at most one row per
+    day, book, student or course, however long the history is.
+    """
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    period = request.args.get('period', 'day')
+    if period not in ANALYTICS_PERIODS:
+        period = 'day'
+    fmt, days_per_bucket, buckets = ANALYTICS_PERIODS[period]
+    top = max(1, min(request.args.get('top', type=int) or app.config['ANALYTICS_TOP_N'], 100))
+    conn = get_report_connection()
+    try:
+        try:
+            start = parse_day(request.args.get('start', '').strip())
+            end = parse_day(request.args.get('end', '').strip())
+        except ValueError:
+            flash("Dates must be YYYY-MM-DD.")
+            start = end = None
+        if end is None:
+            # Default to the window ending at the latest activity, not today,
+            # so a quiet spell does not show an empty chart.
+            # Only real dates: a hand-edited return date from before it was
+            # validated can leave a day key like 'lost' in the rollup.
+            latest = conn.execute('''
+                SELECT MAX(day) FROM circulation_by_day
+                WHERE day GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+            ''').fetchone()[0]
+            try:
+                end = parse_day(latest) or datetime.now().date()
+            except ValueError:
+                end = datetime.now().date()
+        if start is None:
+            start = end - timedelta(days=days_per_bucket * buckets - 1)
+        series = conn.execute('''
+            SELECT strftime(?, day) AS bucket, SUM(borrows) AS borrows, SUM(returns) AS returns,
+                   SUM(late_returns) AS late_returns
+            FROM circulation_by_day WHERE day BETWEEN ? AND ?
+            GROUP BY bucket ORDER BY bucket
+        ''', (fmt, start.isoformat(), end.isoformat())).fetchall()
+        # CROSS JOIN keeps the rollup outermost, so the top N come straight
+        # off its borrows index instead of from a sort of every book.
+        top_books = conn.execute('''
+            SELECT b.id, b.title, b.author, r.borrows FROM circulation_by_book r
+            CROSS JOIN books b ON b.id = r.book_id
+            WHERE r.borrows > 0 ORDER BY r.borrows DESC LIMIT ?
+        ''', (top,)).fetchall()
+        top_authors = conn.execute('''
+            SELECT author, borrows FROM circulation_by_author
+            WHERE borrows > 0 ORDER BY borrows DESC LIMIT ?
+        ''', (top,)).fetchall()
+        top_borrowers = conn.execute('''
+            SELECT s.fullname, s.student_number, s.course, r.borrows FROM circulation_by_student r
+            CROSS JOIN students s ON s.id = r.student_id
+            WHERE r.borrows > 0 ORDER BY r.borrows DESC LIMIT ?
+        ''', (top,)).fetchall()
+        courses = conn.execute('''
+            SELECT course, borrows, returns, loan_seconds, late_returns FROM circulation_by_course
+            WHERE borrows > 0 ORDER BY borrows DESC
+        ''').fetchall()
+    finally:
+        conn.close()
+    overall = {m: sum(c[m] for c in courses) for m in ('borrows', 'returns', 'loan_seconds', 'late_returns')}
+    return render_template('admin_analytics.html', period=period, start=start, end=end, top=top,
+                           series=series, peak=max((r['borrows'] for r in series), default=0),
+                           top_books=top_books, top_authors=top_authors, top_borrowers=top_borrowers,
+                           courses=[dict(c, **loan_summary(c)) for c in courses],
+                           overall=dict(overall, **loan_summary(overall)))
+
+def parse_id(value):
+    """Parse a numeric id filter; raises ValueError on bad input, including ids SQLite cannot hold."""
+    number = int(value)
+    if not sqlite_scalar(number):
+        raise ValueError(f'id out of range: {value}')
+    return number
+
+def export_filters(args):
+    """Build the WHERE clause for the CSV export from the query string."""
+    clauses, params = [], []
+    start = parse_day(args.get('start', '').strip())
+    end = parse_day(args.get('end', '').strip())
+    if start:
+        clauses.append('br.borrow_ts >= ?')
+        params.append(to_ts(datetime.combine(start, datetime.min.time())))
+    if end:
+        clauses.append('br.borrow_ts < ?')
+        params.append(to_ts(datetime.combine(end + timedelta(days=1), datetime.min.time())))
+    student_number = args.get('student_number', '').strip()
+    if student_number:
+        clauses.append('s.student_number = ?')
+        params.append(student_number)
+    book_id = args.get('book_id', '').strip()
+    if book_id:
+        clauses.append('br.book_id = ?')
+        params.append(parse_id(book_id))
+    since_id = args.get('since_id', '').strip()
+    if since_id:
+        # Nightly jobs pass the last id they saw to pull only new rows.
+        clauses.append('br.id > ?')
+        params.append(parse_id(since_id))
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    return where, params
 
 @app.route('/librarian/reports/download') 
 def librarian_reports_download():
     if session.get('role') != 'librarian': 
         flash("Librarian only.")
         return redirect(url_for('login'))
-    conn = get_db_connection()
-    rows = conn.execute('''
-        SELECT br.id, s.fullname, b.title, br.borrow_date, br.due_date, br.return_date, br.penalty
-        FROM borrow_records br
-        JOIN students s ON br.student_id = s.id -- Changed from users u on user_id
-        JOIN books b ON br.book_id = b.id
-    ''').fetchall()
-    conn.close()
-    si = io.StringIO()
-    cw = csv.writer(si)
-    cw.writerow(['id','student_name','title','borrow_date','due_date','return_date','penalty'])
-    for r in rows:
-        cw.writerow([r['id'], r['fullname'], r['title'], r['borrow_date'], r['due_date'], r['return_date'], r['penalty']])
-    output = si.getvalue()
-    return Response(output, mimetype="text/csv", headers={"Content-Disposition":"attachment;filename=borrow_report.csv"})
+    try:
+        where, params = export_filters(request.args)
+    except ValueError:
+        flash("Invalid report filter. Use YYYY-MM-DD dates and numeric ids.")
+        return redirect(url_for('librarian_reports'))
+    batch_size = app.config['CSV_BATCH_SIZE']
+    conn = get_report_connection()
+    taken_at = g.get('report_taken_at')
+
+    def generate():
+        # Rows are pulled from the cursor in batches and written out as
+        # they arrive, so memory stays flat whatever the history size.
+        try:
+            cur = conn.execute(f'''
+                SELECT br.id, s.fullname, b.title, br.borrow_date, br.due_date, br.return_date, br.penalty
+                FROM borrow_records br
+                JOIN students s ON br.student_id = s.id
+                JOIN books b ON br.book_id = b.id
+                {where}
+                ORDER BY br.id
+            ''', params)
+            si = io.StringIO()
+            cw = csv.writer(si)
+            cw.writerow(['id','student_name','title','borrow_date','due_date','return_date','penalty'])
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                cw.writerows(tuple(r) for r in rows)
+                yield si.getvalue()
+                si.seek(0)
+                si.truncate()
+            yield si.getvalue()
+        finally:
+            conn.close()
+
+    headers = {"Content-Disposition": "attachment;filename=borrow_report.csv"}
+    if taken_at:
+        headers["X-Snapshot-Taken-At"] = taken_at.isoformat(timespec='seconds')
+    return Response(stream_with_context(generate()), mimetype="text/csv", headers=headers)
+
+@app.route('/librarian/reports/refresh', methods=['POST'])
+def librarian_refresh_snapshot():
+    if session.get('role') != 'librarian':
+        flash("Librarian only.")
+        return redirect(url_for('login'))
+    if app.config['REPORT_SNAPSHOT']:
+        get_snapshot().refresh()
+        flash("Report snapshot refreshed.")
+    back = request.form.get('next')
+    return redirect(url_for(back if back in ('librarian_reports', 'librarian_penalties', 'librarian_analytics')
+                            else 'librarian_reports'))
+
+@app.cli.command('refresh-snapshot')
+def refresh_snapshot_command():
+    """Copy every branch database to its report snapshot (run from cron, e.g. every few minutes)."""
+    for branch in branch_databases():
+        get_pool(branch)  # migrate before copying
+        snapshot = get_snapshot(branch)
+        started = time.monotonic()
+        snapshot.refresh()
+        click.echo(f"Snapshot {snapshot.path} refreshed in {time.monotonic() - started:.1f}s.")
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations to every branch database."""
+    for branch, path in branch_databases().items():
+        get_pool(branch)
+        click.echo(f"{branch}: {path} is at schema version {len(create_library_db.MIGRATIONS)}.")
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,185 @@
+"""Benchmark librarian logins under a login storm, and what it does to everyone else.
+
+Serves the app from a threaded werkzeug server on a temporary database,
+then for each PASSWORD_WORKERS setting measures:
+
+  * idle: the latency of a cheap page (the visitor catalog) with no logins;
+  * storm: --concurrency threads logging in as fast as they can for
+    --seconds, while the same page is probed alongside them.
+
+It reports logins per second, how many were refused with a 429, login
+latency, and the probe's latency during the storm next to its idle
+latency. With PASSWORD_WORKERS=0 every login hashes on a request thread;
+with a pool the hashing moves to other processes and PASSWORD_QUEUE_LIMIT
+caps how much of it can pile up:
+
+    python benchmark_login.py
+    python benchmark_login.py --workers 0,1,4 --concurrency 32 --queue-limit 8
+    python benchmark_login.py --method scrypt:16384:8:1 --out login.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+import app as library_app
+import create_library_db
+
+PASSWORD = 'benchmark-password'
+counts_lock = threading.Lock()
+
+
+def build_database(path, librarians, method):
+    conn = sqlite3.connect(path)
+    create_library_db.migrate(conn)
+    create_library_db.seed(conn)
+    # One hash shared by every account: only the cost matters here.
+    pw_hash = generate_password_hash(PASSWORD, method)
+    conn.executemany('INSERT INTO users (fullname, username, password, role) VALUES (?, ?, ?, ?)',
+                     ((f'Bench Librarian {i}', f'bench{i}', pw_hash, 'librarian') for i in range(librarians)))
+    conn.commit()
+    conn.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return round(sorted_values[max(0, min(len(sorted_values) - 1, round(len(sorted_values) * p / 100) - 1))], 1)
+
+
+def request(port, method, path, body=None):
+    """One request on a fresh connection; returns (status, milliseconds)."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+    started = time.perf_counter()
+    conn.request(method, path, body, headers)
+    response = conn.getresponse()
+    response.read()
+    elapsed = (time.perf_counter() - started) * 1000
+    conn.close()
+    return response.status, elapsed
+
+
+def probe(port, deadline, timings):
+    while time.monotonic() < deadline:
+        status, ms = request(port, 'GET', '/')
+        if status == 200:
+            timings.append(ms)
+        time.sleep(0.01)
+
+
+def storm(port, deadline, n, librarians, counts, timings):
+    i = n
+    while time.monotonic() < deadline:
+        body = urllib.parse.urlencode({'login_type': 'librarian', 'username': f'bench{i % librarians}',
+                                       'password': PASSWORD})
+        status, ms = request(port, 'POST', '/login', body)
+        outcome = {302: 'ok', 429: 'rejected'}.get(status, 'error')
+        with counts_lock:
+            counts[outcome] += 1
+        if outcome == 'ok':
+            timings.append(ms)
+        i += 1
+
+
+def reset_hasher():
+    if library_app._hasher is not None:
+        library_app._hasher.shutdown()
+        library_app._hasher = None
+
+
+def run(port, workers, args):
+    library_app.app.config['PASSWORD_WORKERS'] = workers
+    reset_hasher()
+    # Start the pool before timing anything.
+    library_app.hash_password('')
+
+    idle = []
+    probe(port, time.monotonic() + args.idle_seconds, idle)
+
+    busy, logins = [], []
+    counts = {'ok': 0, 'rejected': 0, 'error': 0}
+    deadline = time.monotonic() + args.seconds
+    threads = [threading.Thread(target=storm, args=(port, deadline, n, args.librarians, counts, logins))
+               for n in range(args.concurrency)]
+    threads.append(threading.Thread(target=probe, args=(port, deadline, busy)))
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    idle.sort()
+    busy.sort()
+    logins.sort()
+    return {
+        'workers': workers,
+        'logins_per_second': round(counts['ok'] / elapsed, 1),
+        'rejected_429': counts['rejected'],
+        'errors': counts['error'],
+        'login_p50_ms': percentile(logins, 50),
+        'login_p99_ms': percentile(logins, 99),
+        'probe_idle_p50_ms': percentile(idle, 50),
+        'probe_storm_p50_ms': percentile(busy, 50),
+        'probe_storm_p99_ms': percentile(busy, 99),
+        'probes': len(busy),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default=f'0,{os.cpu_count() or 2}',
+                        help='comma-separated PASSWORD_WORKERS settings to compare')
+    parser.add_argument('--concurrency', type=int, default=16, help='threads logging in at once')
+    parser.add_argument('--seconds', type=float, default=10, help='length of each storm')
+    parser.add_argument('--idle-seconds', type=float, default=2, help='probing before each storm')
+    parser.add_argument('--queue-limit', type=int, default=library_app.app.config['PASSWORD_QUEUE_LIMIT'],
+                        help='PASSWORD_QUEUE_LIMIT (default: %(default)s)')
+    parser.add_argument('--method', default=library_app.app.config['PASSWORD_HASH_METHOD'],
+                        help='PASSWORD_HASH_METHOD (default: %(default)s)')
+    parser.add_argument('--librarians', type=int, default=100, help='accounts the storm cycles through')
+    parser.add_argument('--out', help='write JSON results here')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'login.db')
+    build_database(path, args.librarians, args.method)
+    library_app.DB = path
+    library_app.app.config.update(PASSWORD_HASH_METHOD=args.method, PASSWORD_QUEUE_LIMIT=args.queue_limit)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server('127.0.0.1', 0, library_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    print(f"{args.method}, {args.concurrency} concurrent logins, queue limit {args.queue_limit}, "
+          f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>7} {'logins/s':>8} {'429s':>6} {'login p50':>9} {'login p99':>9} "
+          f"{'idle p50':>8} {'storm p50':>9} {'storm p99':>9}")
+    try:
+        for workers in (int(w) for w in args.workers.split(',')):
+            r = run(server.server_port, workers, args)
+            results.append(r)
+            print(f"{r['workers']:>7} {r['logins_per_second']:>8} {r['rejected_429']:>6} "
+                  f"{r['login_p50_ms']!s:>9} {r['login_p99_ms']!s:>9} {r['probe_idle_p50_ms']!s:>8} "
+                  f"{r['probe_storm_p50_ms']!s:>9} {r['probe_storm_p99_ms']!s:>9}")
+    finally:
+        server.shutdown()
+        reset_hasher()
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""Benchmark every route through Flask's test client.
+
+Point it at a database built by generate_library_data.py. The database is
+copied to a temporary file first (pass --in-place to skip that), because
+the write routes really write. Each scenario is requested --requests times
+after --warmup untimed rounds, as a visitor, a logged-in student or a
+logged-in librarian, and reported as p50/p95/p99 latency, SQL statements
+per request and peak Python memory (from a separate tracemalloc round, so
+tracing does not slow the timed one):
+
+    python generate_library_data.py --db bench.db
+    python benchmark_routes.py --db bench.db --out baseline.json
+    python benchmark_routes.py --db bench.db --baseline baseline.json   # exits 1 on regressions
+
+A scenario regresses when its p95 or peak memory grows by more than
+--tolerance over the baseline, or when it issues more statements.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import app as library_app
+
+# FTS5 shadow-table statements and transaction control are not queries
+# the route wrote, so they are not counted. Trigger programs are traced
+# as repeats of the statement that fired them, so consecutive repeats
+# count once; executemany() still counts once per row.
+NOT_COUNTED = re.compile(r"^\s*(--|PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)|'main'\.", re.I)
+
+LATENCY_SLACK_MS = 1.0  # ignore p95 changes smaller than this
+
+
+class Bench:
+    """Logged-in clients, ids to request, and state shared between write scenarios."""
+
+    def __init__(self, db_path):
+        self.clients = {name: library_app.app.test_client() for name in ('visitor', 'student', 'librarian')}
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        # The student with the most recent loan has a history to page through.
+        self.student = conn.execute('''
+            SELECT s.* FROM students s
+            WHERE s.id = (SELECT student_id FROM borrow_records ORDER BY id DESC LIMIT 1)
+        ''').fetchone() or conn.execute('SELECT * FROM students LIMIT 1').fetchone()
+        self.book = conn.execute('SELECT * FROM books ORDER BY id LIMIT 1').fetchone()
+        self.record = conn.execute(
+            'SELECT * FROM borrow_records WHERE return_date IS NOT NULL ORDER BY id DESC LIMIT 1').fetchone()
+        self.max_record_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM borrow_records').fetchone()[0]
+        mid_book = conn.execute('SELECT COALESCE(MAX(id), 0) / 2 FROM books').fetchone()[0]
+        mid_record = conn.execute('''
+            SELECT borrow_ts, id FROM borrow_records
+            WHERE id >= (SELECT COALESCE(MAX(id), 0) / 2 FROM borrow_records) ORDER BY id LIMIT 1
+        ''').fetchone()
+        self.word = (self.book['title'].split() or ['book'])[0] if self.book else 'book'
+        conn.close()
+        self.deep_books = library_app.encode_cursor([mid_book])
+        self.deep_records = library_app.encode_cursor(list(mid_record)) if mid_record else ''
+        self.loans, self.returned, self.added_books, self.added_students = [], [], [], []
+        self.serial = 0
+
+        self.clients['student'].post('/login', data=self.student_login())
+        self.clients['librarian'].post('/login', data=self.librarian_login())
+
+    def student_login(self):
+        return {'login_type': 'student', 'student_number': self.student['student_number'],
+                'lastname': self.student['lastname']}
+
+    @staticmethod
+    def librarian_login():
+        return {'login_type': 'librarian', 'username': 'librarian', 'password': 'librarian123'}
+
+    def next_serial(self):
+        self.serial += 1
+        return self.serial
+
+    def available_book(self):
+        conn = library_app.get_db_connection()
+        row = conn.execute('SELECT id FROM books WHERE available = 1 ORDER BY id DESC LIMIT 1').fetchone()
+        conn.close()
+        return row[0]
+
+    def last_id(self, table):
+        conn = library_app.get_db_connection()
+        row = conn.execute(f'SELECT MAX(id) FROM {table}').fetchone()
+        conn.close()
+        return row[0]
+
+    # Write scenarios come in pairs that undo each other (borrow/return,
+    # add/delete), so the database does not drift over a long run.
+    def borrow(self):
+        book_id = self.available_book()
+        return 'student', 'POST', f'/borrow/{book_id}', None
+
+    def after_borrow(self):
+        self.loans.append(self.last_id('borrow_records'))
+
+    def give_back(self):
+        record_id = self.loans.pop()
+        self.returned.append(record_id)
+        return 'student', 'POST', f'/return/{record_id}', None
+
+    def delete_returned(self):
+        return 'librarian', 'POST', f'/librarian/borrow_records/delete/{self.returned.pop()}', None
+
+    def add_book(self):
+        return 'librarian', 'POST', '/librarian/books/add', {'title': f'Bench Book {self.next_serial()}',
+                                                             'author': 'Bench Author'}
+
+    def after_add_book(self):
+        self.added_books.append(self.last_id('books'))
+
+    def delete_book(self):
+        return 'librarian', 'POST', f'/librarian/books/delete/{self.added_books.pop()}', None
+
+    def add_student(self):
+        return 'librarian', 'POST', '/librarian/students/add', {
+            'fullname': f'Bench Student{self.next_serial()}', 'student_number': f'BENCH{self.serial}',
+            'course': 'IT'}
+
+    def after_add_student(self):
+        self.added_students.append(self.last_id('students'))
+
+    def delete_student(self):
+        return 'librarian', 'POST', f'/librarian/students/delete/{self.added_students.pop()}', None
+
+    def register(self):
+        n = self.next_serial()
+        return 'visitor', 'POST', '/register', {'register_type': 'student', 'fullname': f'Bench Register{n}',
+                                                'student_number': f'BENCHREG{n}', 'course': 'IT'}
+
+    def edit_book(self):
+        return 'librarian', 'POST', f"/librarian/books/edit/{self.book['id']}", {
+            'title': self.book['title'], 'author': self.book['author'], 'available': str(self.book['available'])}
+
+    def edit_student(self):
+        s = self.student
+        return 'librarian', 'POST', f"/librarian/students/edit/{s['id']}", {
+            'fullname': s['fullname'], 'student_number': s['student_number'], 'course': s['course']}
+
+    def edit_borrow(self):
+        r = self.record
+        return 'librarian', 'POST', f"/librarian/borrow_records/edit/{r['id']}", {
+            'return_date': r['return_date'], 'penalty': str(r['penalty'])}
+
+    def import_books(self):
+        body = 'title,author\n' + ''.join(f'Bench Import {self.next_serial()},Bench Author\n' for _ in range(100))
+        return 'librarian', 'POST', '/librarian/books/import', {'file': (io.BytesIO(body.encode()), 'books.csv')}
+
+    def import_students(self):
+        body = 'fullname,student_number,course\n' + ''.join(
+            f'Bench Import{n},BENCHIMP{n},IT\n' for n in (self.next_serial() for _ in range(100)))
+        return 'librarian', 'POST', '/librarian/students/import', {
+            'file': (io.BytesIO(body.encode()), 'students.csv')}
+
+
+def get(who, path):
+    return lambda bench: (who, 'GET', path(bench) if callable(path) else path, None)
+
+
+def post(who, path, form):
+    return lambda bench: (who, 'POST', path, form(bench) if callable(form) else form)
+
+
+# (name, request builder, optional hook run after the response). Order
+# matters for the write pairs: borrow, return, then delete the record.
+SCENARIOS = [
+    ('index', get('visitor', '/'), None),
+    ('register_form', get('visitor', '/register'), None),
+    ('register', Bench.register, None),
+    ('login_form', get('visitor', '/login'), None),
+    ('login_student', post('visitor', '/login', Bench.student_login), None),
+    ('login_librarian', post('visitor', '/login', Bench.librarian_login()), None),
+    ('logout', get('visitor', '/logout'), None),
+    ('search_form', get('visitor', '/search'), None),
+    ('search', post('visitor', '/search', lambda b: {'keyword': b.word}), None),
+    ('suggest', get('visitor', lambda b: f'/api/suggest?q={b.word[:3]}'), None),
+    ('student_dashboard', get('student', '/student'), None),
+    ('my_history', get('student', '/my_history'), None),
+    ('borrow_book', Bench.borrow, Bench.after_borrow),
+    ('return_book', Bench.give_back, None),
+    ('librarian_dashboard', get('librarian', '/librarian'), None),
+    ('librarian_books', get('librarian', '/librarian/books'), None),
+    ('librarian_books_deep', get('librarian', lambda b: f'/librarian/books?after={b.deep_books}'), None),
+    ('librarian_add_book', Bench.add_book, Bench.after_add_book),
+    ('librarian_delete_book', Bench.delete_book, None),
+    ('librarian_edit_book_form', get('librarian', lambda b: f"/librarian/books/edit/{b.book['id']}"), None),
+    ('librarian_edit_book', Bench.edit_book, None),
+    ('librarian_import_books', Bench.import_books, None),
+    ('librarian_students', get('librarian', '/librarian/students'), None),
+    ('librarian_add_student', Bench.add_student, Bench.after_add_student),
+    ('librarian_delete_student', Bench.delete_student, None),
+    ('librarian_edit_student_form', get('librarian', lambda b: f"/librarian/students/edit/{b.student['id']}"), None),
+    ('librarian_edit_student', Bench.edit_student, None),
+    ('librarian_import_students', Bench.import_students, None),
+    ('librarian_borrow_records', get('librarian', '/librarian/borrow_records'), None),
+    ('librarian_borrow_records_deep',
+     get('librarian', lambda b: f'/librarian/borrow_records?after={b.deep_records}'), None),
+    ('librarian_edit_borrow_form', get('librarian', lambda b: f"/librarian/borrow_records/edit/{b.record['id']}"),
+     None),
+    ('librarian_edit_borrow', Bench.edit_borrow, None),
+    ('librarian_delete_borrow', Bench.delete_returned, None),
+    ('librarian_penalties', get('librarian', '/librarian/penalties'), None),
+    ('librarian_penalties_accruing', get('librarian', '/librarian/penalties?status=accruing'), None),
+    ('librarian_accrue_penalties', post('librarian', '/librarian/penalties/accrue', {}), None),
+    ('librarian_reports', get('librarian', '/librarian/reports'), None),
+    ('librarian_analytics', get('librarian', '/librarian/reports/analytics'), None),
+    ('librarian_analytics_month', get('librarian', '/librarian/reports/analytics?period=month'), None),
+    ('librarian_reports_download_recent',
+     get('librarian', lambda b: f'/librarian/reports/download?since_id={max(b.max_record_id - 1000, 0)}'), None),
+]
+
+# The unfiltered export reads the whole history; only run it when asked.
+FULL_EXPORT = ('librarian_reports_download', get('librarian', '/librarian/reports/download'), None)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_round(bench, scenarios, rounds, counter, results=None, memory=None):
+    for name, build, after in scenarios:
+        for _ in range(rounds):
+            who, method, path, data = build(bench)
+            client = bench.clients[who]
+            counter[:] = [0, None]
+            if memory is not None:
+                tracemalloc.reset_peak()
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            response.get_data()  # drain streamed bodies inside the timing
+            elapsed = time.perf_counter() - started
+            response.close()
+            if response.status_code >= 500:
+                raise RuntimeError(f'{name}: {method} {path} returned {response.status_code}')
+            if after:
+                after(bench)
+            if results is not None:
+                entry = results.setdefault(name, {'times': [], 'queries': []})
+                entry['times'].append(elapsed * 1000)
+                entry['queries'].append(counter[0])
+            if memory is not None:
+                memory[name] = max(memory.get(name, 0), tracemalloc.get_traced_memory()[1])
+
+
+def summarize(results, memory):
+    summary = {}
+    for name, entry in results.items():
+        times = sorted(entry['times'])
+        summary[name] = {
+            'requests': len(times),
+            'p50_ms': round(percentile(times, 50), 3),
+            'p95_ms': round(percentile(times, 95), 3),
+            'p99_ms': round(percentile(times, 99), 3),
+            'mean_ms': round(sum(times) / len(times), 3),
+            'queries_per_request': round(sum(entry['queries']) / len(entry['queries']), 2),
+            'peak_memory_kb': round(memory.get(name, 0) / 1024, 1),
+        }
+    return summary
+
+
+def compare(current, baseline, tolerance):
+    """Yield one message per scenario metric that regressed against the baseline."""
+    for name, base in baseline.items():
+        now = current.get(name)
+        if now is None:
+            continue
+        if now['p95_ms'] > base['p95_ms'] * (1 + tolerance) + LATENCY_SLACK_MS:
+            yield f"{name}: p95 {base['p95_ms']:.2f}ms -> {now['p95_ms']:.2f}ms"
+        if now['queries_per_request'] > base['queries_per_request']:
+            yield f"{name}: queries/request {base['queries_per_request']} -> {now['queries_per_request']}"
+        if now['peak_memory_kb'] > base['peak_memory_kb'] * (1 + tolerance) + 64:
+            yield f"{name}: peak memory {base['peak_memory_kb']}KB -> {now['peak_memory_kb']}KB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', required=True, help='database to benchmark (see generate_library_data.py)')
+    parser.add_argument('--requests', type=int, default=50, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed requests per scenario first')
+    parser.add_argument('--only', help='regex; run only the scenarios whose name matches')
+    parser.add_argument('--full-export', action='store_true', help='also time the unfiltered CSV export')
+    parser.add_argument('--in-place', action='store_true', help='benchmark --db itself instead of a copy')
+    parser.add_argument('--out', help='write JSON results here')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    db_path = args.db
+    if not args.in_place:
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        src = sqlite3.connect(args.db)
+        dst = sqlite3.connect(db_path)
+        src.backup(dst)
+        dst.close()
+        src.close()
+
+    library_app.DB = db_path
+    library_app.app.config['TESTING'] = True
+    counter = [0, None]  # statements in this request, last statement seen
+
+    def count(sql):
+        if NOT_COUNTED.search(sql):
+            return
+        if sql != counter[1]:
+            counter[0] += 1
+        counter[1] = sql
+
+    pool = library_app.get_pool()
+    # Let the suggest index's startup build finish so its SQL is not traced.
+    library_app.get_suggest_index().wait()
+    pool.close_all()
+    pool.on_connect.append(lambda conn: conn.set_trace_callback(count))
+
+    scenarios = SCENARIOS + ([FULL_EXPORT] if args.full_export else [])
+    if args.only:
+        scenarios = [s for s in scenarios if re.search(args.only, s[0])]
+    bench = Bench(db_path)
+
+    run_round(bench, scenarios, args.warmup, counter)
+    results = {}
+    run_round(bench, scenarios, args.requests, counter, results=results)
+    memory = {}
+    tracemalloc.start()
+    run_round(bench, scenarios, 1, counter, memory=memory)
+    tracemalloc.stop()
+    summary = summarize(results, memory)
+
+    print(f"{'scenario':<36} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8} {'peak KB':>9}")
+    for name, s in summary.items():
+        print(f"{name:<36} {s['p50_ms']:>8.2f} {s['p95_ms']:>8.2f} {s['p99_ms']:>8.2f} "
+              f"{s['queries_per_request']:>8} {s['peak_memory_kb']:>9}")
+
+    conn = sqlite3.connect(db_path)
+    counts = {t: conn.execute(f'SELECT COUNT(*) FROM {t}').fetchone()[0]
+              for t in ('books', 'students', 'borrow_records')}
+    conn.close()
+    pool.close_all()
+    if not args.in_place:
+        shutil.rmtree(os.path.dirname(db_path), ignore_errors=True)
+
+    output = {
+        'meta': {'db': os.path.abspath(args.db), 'rows': counts, 'requests': args.requests,
+                 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                 'finished_at': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'scenarios': summary,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'Results written to {args.out}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scenarios']
+        regressions = list(compare(summary, baseline, args.tolerance))
+        for message in regressions:
+            print(f'❌ {message}')
+        if regressions:
+            return 1
+        print(f'✅ no regressions against {args.baseline}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
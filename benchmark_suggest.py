@@ -0,0 +1,120 @@
+"""Benchmark the /api/suggest prefix index: build time, memory and lookup latency.
+
+Builds app.PrefixIndex over synthetic catalogs of each size (titles and
+authors from generate_library_data.py), then times lookups for random
+one-word and two-word prefixes and incremental edits:
+
+    python benchmark_suggest.py
+    python benchmark_suggest.py --sizes 100000,1000000 --queries 20000
+
+Memory is what tracemalloc sees allocated by the build: the sorted word
+list, the id arrays and the folded words kept per book. Display titles
+are not held in memory; /api/suggest reads them from SQLite by id.
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import app as library_app
+import generate_library_data
+
+
+def catalog(size, seed):
+    rng = random.Random(seed)
+    for book_id, (title, author) in enumerate(generate_library_data.books(rng, size), start=1):
+        yield book_id, title, author
+
+
+def percentile(sorted_values, p):
+    return sorted_values[max(0, min(len(sorted_values) - 1, round(len(sorted_values) * p / 100) - 1))]
+
+
+def queries(rng, count):
+    words = [w.lower() for w in generate_library_data.TITLE_WORDS + generate_library_data.LAST_NAMES]
+    for _ in range(count):
+        first = rng.choice(words)
+        q = first[:rng.randint(1, len(first))]
+        if rng.random() < 0.3:
+            second = rng.choice(words)
+            q = f'{first} {second[:rng.randint(1, len(second))]}'
+        yield q
+
+
+def run(size, args):
+    rows = list(catalog(size, args.seed))
+    gc.collect()
+    index = library_app.PrefixIndex()
+    started = time.perf_counter()
+    index.build(rows, version=0)
+    build_seconds = time.perf_counter() - started
+
+    # Memory: build again from fresh strings, the way rows arrive from SQLite.
+    del index
+    gc.collect()
+    tracemalloc.start()
+    index = library_app.PrefixIndex()
+    index.build(catalog(size, args.seed), version=0)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    rng = random.Random(args.seed)
+    timings = []
+    for q in queries(rng, args.queries):
+        t = time.perf_counter_ns()
+        index.search(q, args.limit)
+        timings.append((time.perf_counter_ns() - t) / 1000)
+    timings.sort()
+
+    edits = []
+    for n in range(args.edits):
+        book_id = size + n + 1
+        t = time.perf_counter_ns()
+        index.apply(n + 1, book_id, f'Benchmark Title {n}', 'Benchmark Author')
+        edits.append((time.perf_counter_ns() - t) / 1000)
+    edits.sort()
+
+    stats = index.stats()
+    return {
+        'titles': size,
+        'tokens': stats['tokens'],
+        'build_seconds': round(build_seconds, 3),
+        'build_seconds_per_100k': round(build_seconds * 100000 / size, 3),
+        'memory_mb': round(memory / 2 ** 20, 1),
+        'memory_mb_per_100k': round(memory / 2 ** 20 * 100000 / size, 1),
+        'query_p50_us': round(percentile(timings, 50), 1),
+        'query_p99_us': round(percentile(timings, 99), 1),
+        'edit_p50_us': round(percentile(edits, 50), 1) if edits else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100000,500000', help='comma-separated catalog sizes')
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--edits', type=int, default=1000, help='incremental adds timed after the build')
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--out', help='write JSON results here')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'titles':>9} {'tokens':>7} {'build s':>8} {'s/100k':>7} {'MB':>7} {'MB/100k':>8} "
+          f"{'p50 us':>7} {'p99 us':>7} {'edit us':>8}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        r = run(size, args)
+        results.append(r)
+        print(f"{r['titles']:>9} {r['tokens']:>7} {r['build_seconds']:>8} {r['build_seconds_per_100k']:>7} "
+              f"{r['memory_mb']:>7} {r['memory_mb_per_100k']:>8} {r['query_p50_us']:>7} "
+              f"{r['query_p99_us']:>7} {r['edit_p50_us']:>8}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""Precompress and re-encode the files in static/ for the app to serve.
+
+For every text asset (CSS, JS, SVG, ...) this writes a gzip ``.gz`` and,
+when the ``brotli`` package is installed, a ``.br`` next to it. For every
+PNG/JPEG it writes ``.webp`` and ``.avif`` versions when Pillow can
+encode them. The static route in app.py picks the smallest variant the
+browser accepts and falls back to the original, so anything this script
+cannot build is simply not offered. Run it after changing a static file:
+
+    python build_static.py
+    python build_static.py --quality 70     # smaller images
+
+A variant that would not be smaller than its original is not written.
+"""
+import argparse
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+else:
+    try:
+        import pillow_avif  # noqa: F401  (registers AVIF on Pillow < 11.3)
+    except ImportError:
+        pass
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+TEXT_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.map'}
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+
+def write_if_smaller(path, data, original_size):
+    if len(data) >= original_size:
+        if os.path.exists(path):
+            os.remove(path)
+        return f'{os.path.basename(path)}: not smaller, skipped'
+    with open(path, 'wb') as f:
+        f.write(data)
+    return f'{os.path.basename(path)}: {original_size} -> {len(data)} bytes ({len(data) / original_size:.0%})'
+
+
+def compress_text(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    # mtime=0 keeps the output identical from run to run.
+    yield write_if_smaller(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0), len(data))
+    if brotli is not None:
+        yield write_if_smaller(path + '.br', brotli.compress(data, quality=11), len(data))
+    else:
+        yield f'{os.path.basename(path)}.br: skipped (pip install brotli)'
+
+
+def encode_image(path, quality):
+    if Image is None:
+        yield f'{os.path.basename(path)}: image variants skipped (pip install Pillow)'
+        return
+    size = os.path.getsize(path)
+    stem = os.path.splitext(path)[0]
+    with Image.open(path) as img:
+        img.load()
+        for fmt, suffix, options in (('WEBP', '.webp', {'quality': quality, 'method': 6}),
+                                     ('AVIF', '.avif', {'quality': quality})):
+            tmp = stem + suffix + '.tmp'
+            try:
+                img.save(tmp, fmt, **options)
+            except (KeyError, OSError, ValueError) as exc:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                yield f'{os.path.basename(stem + suffix)}: skipped ({fmt} not supported by this Pillow: {exc})'
+                continue
+            with open(tmp, 'rb') as f:
+                data = f.read()
+            os.remove(tmp)
+            yield write_if_smaller(stem + suffix, data, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--static', default=STATIC, help='directory to process (default: %(default)s)')
+    parser.add_argument('--quality', type=int, default=80, help='WebP/AVIF quality, 0-100')
+    args = parser.parse_args()
+
+    for name in sorted(os.listdir(args.static)):
+        path = os.path.join(args.static, name)
+        ext = os.path.splitext(name)[1].lower()
+        if not os.path.isfile(path):
+            continue
+        if ext in TEXT_EXTENSIONS:
+            messages = compress_text(path)
+        elif ext in IMAGE_EXTENSIONS:
+            messages = encode_image(path, args.quality)
+        else:
+            continue
+        for message in messages:
+            print(f'  {message}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
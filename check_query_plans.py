@@ -0,0 +1,173 @@
+"""EXPLAIN QUERY PLAN every SQL statement the app's routes issue.
+
+Builds a throwaway database with the current migrations, drives each route
+through Flask's test client as a visitor, a student and a librarian, records
+every statement SQLite runs and asks SQLite how it would execute it. Any
+full table scan that is not explicitly allowed below is reported and the
+script exits non-zero, so a new query cannot quietly fall off an index:
+
+    python check_query_plans.py
+    python check_query_plans.py -v      # print every plan
+"""
+import argparse
+import io
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+import app as library_app
+import create_library_db
+
+# Scans that are fine on purpose, by endpoint. Aliases are as they appear
+# in the plan (e.g. ``br`` for borrow_records in the joined queries).
+ALLOWED_SCANS = {
+    # Full export by design; it streams in id order.
+    'librarian_reports_download': {'br'},
+    # LIKE fallback when FTS5 is unavailable.
+    'search': {'books'},
+    # One rollup row per course; the whole table is the report.
+    'librarian_analytics': {'circulation_by_course'},
+}
+
+# POST requests to replay on top of every GET route: (session, path, form).
+POSTS = [
+    ('visitor', '/search', {'keyword': 'hobbit'}),
+    ('visitor', '/login', {'login_type': 'student', 'student_number': 'S2024001', 'lastname': 'Student'}),
+    ('visitor', '/login', {'login_type': 'librarian', 'username': 'librarian', 'password': 'librarian123'}),
+    ('visitor', '/branches', {'branch': 'main'}),
+    ('student', '/borrow/1', {}),
+    ('student', '/return/1', {}),
+    ('kiosk', '/api/kiosk/circulation', {'student_number': 'S2024001', 'items': [
+        {'action': 'checkout', 'book_id': 1}, {'action': 'return', 'book_id': 1}]}),
+    ('librarian', '/librarian/books/add', {'title': 'Plan Check', 'author': 'Nobody'}),
+    ('librarian', '/librarian/books/edit/2', {'title': 'Plan Check 2', 'author': 'Nobody', 'available': '1'}),
+    ('librarian', '/librarian/students/add', {'fullname': 'Plan Check', 'student_number': 'P1', 'course': 'IT'}),
+    ('librarian', '/librarian/students/edit/1', {'fullname': 'Sample Student', 'student_number': 'S2024001', 'course': 'IT'}),
+    ('librarian', '/librarian/borrow_records/edit/1', {'return_date': '', 'penalty': '0'}),
+    ('librarian', '/librarian/borrow_records/bulk', {'action': 'return', 'ids': '1,2'}),
+    ('librarian', '/librarian/borrow_records/bulk', {'action': 'set_penalty', 'penalty': '5', 'ids': '1,2'}),
+    ('librarian', '/librarian/borrow_records/bulk', {'action': 'waive', 'ids': '1,2'}),
+    ('librarian', '/librarian/books/bulk', {'action': 'unavailable', 'ids': '4'}),
+    ('librarian', '/librarian/books/bulk', {'action': 'available', 'ids': '4'}),
+    ('librarian', '/librarian/borrow_records/delete/1', {}),
+    ('librarian', '/librarian/books/delete/3', {}),
+    ('librarian', '/librarian/students/delete/2', {}),
+    ('librarian', '/librarian/books/bulk', {'action': 'delete', 'ids': '4'}),
+    ('librarian', '/librarian/students/bulk', {'action': 'delete', 'ids': '3'}),
+    ('librarian', '/librarian/borrow_records/bulk', {'action': 'delete', 'ids': '2'}),
+    ('librarian', '/librarian/penalties/accrue', {}),
+    ('librarian', '/librarian/reports/refresh', {'next': 'librarian_penalties'}),
+    ('librarian', '/librarian/books/import', {'file': (io.BytesIO(b'title,author\nImported,Someone\n'), 'books.csv')}),
+    ('librarian', '/librarian/students/import',
+     {'file': (io.BytesIO(b'fullname,student_number,course\nImported Student,I1,IT\n'), 'students.csv')}),
+]
+
+# Trigger bodies (reported as comments), transaction control, and the
+# statements SQLite runs internally against FTS5 shadow tables.
+SKIP = re.compile(r"^\s*(--|PRAGMA|BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|CREATE|ANALYZE)|'main'\.", re.I)
+SCAN = re.compile(r'^SCAN (\w+)')
+
+
+def build_database(path):
+    conn = sqlite3.connect(path)
+    create_library_db.migrate(conn)
+    create_library_db.seed(conn)
+    conn.close()
+
+
+def sample_get_paths(flask_app):
+    """One concrete URL per GET route, with 1 for every id argument."""
+    for rule in flask_app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.endpoint == 'static':
+            continue
+        yield rule.endpoint, rule.build({arg: 1 for arg in rule.arguments})[1]
+
+
+def session_for(endpoint):
+    if endpoint.startswith('librarian'):
+        return 'librarian'
+    # Logging the student out would spoil the POSTs that follow.
+    return 'visitor' if endpoint == 'logout' else 'student'
+
+
+def explain(conn, sql):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+
+
+def bad_scans(endpoint, sql, plan):
+    # An ordered scan that stops at a LIMIT reads one page, not the table.
+    bounded = re.search(r'\bLIMIT\b', sql, re.I) and not any('TEMP B-TREE' in d for d in plan)
+    allowed = ALLOWED_SCANS.get(endpoint, set())
+    for detail in plan:
+        m = SCAN.match(detail)
+        if m and 'VIRTUAL TABLE' not in detail and not bounded and m.group(1) not in allowed:
+            yield detail
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every statement and its plan')
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'plans.db')
+    build_database(db_path)
+    library_app.DB = db_path
+    library_app.app.config['TESTING'] = True
+    library_app.app.config['KIOSK_TOKENS'] = {'plan-check': 'plan check'}
+
+    statements = []
+    pool = library_app.get_pool()
+    # Let the suggest index's startup build finish so its SQL is not traced.
+    library_app.get_suggest_index().wait()
+    pool.close_all()
+    pool.on_connect.append(lambda conn: conn.set_trace_callback(statements.append))
+
+    clients = {name: library_app.app.test_client() for name in ('visitor', 'student', 'librarian', 'kiosk')}
+    clients['kiosk'].environ_base['HTTP_AUTHORIZATION'] = 'Bearer plan-check'
+    clients['student'].post('/login', data=POSTS[1][2])
+    clients['librarian'].post('/login', data=POSTS[2][2])
+
+    seen = {}   # (endpoint, sql) -> None, in first-seen order
+    requests = [(session_for(endpoint), 'GET', path, None, endpoint)
+                for endpoint, path in sample_get_paths(library_app.app)]
+    requests += [(who, 'POST', path, form, None) for who, path, form in POSTS]
+    exercised = set()
+    for who, method, path, form, endpoint in requests:
+        del statements[:]
+        client = clients[who]
+        if method == 'GET':
+            response = client.get(path)
+        elif who == 'kiosk':
+            response = client.post(path, json=form)
+        else:
+            response = client.post(path, data=form)
+        response.close()
+        endpoint = endpoint or library_app.app.url_map.bind('').match(path, method=method)[0]
+        exercised.add(endpoint)
+        for sql in statements:
+            if not SKIP.search(sql):
+                seen.setdefault((endpoint, sql.strip()), None)
+
+    conn = sqlite3.connect(db_path)
+    failures = 0
+    for endpoint, sql in seen:
+        plan = explain(conn, sql)
+        problems = list(bad_scans(endpoint, sql, plan))
+        if args.verbose or problems:
+            print(f'[{endpoint}] {" ".join(sql.split())}')
+            for detail in plan:
+                print(f'    {"!! " if detail in problems else ""}{detail}')
+        failures += bool(problems)
+
+    missing = {r.endpoint for r in library_app.app.url_map.iter_rules()} - exercised - {'static'}
+    for endpoint in sorted(missing):
+        print(f'⚠️ {endpoint} was not exercised; add a request for it to POSTS.')
+
+    print(f'{len(seen)} statements checked, {failures} with unindexed scans.')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,75 +1,669 @@
+"""Create or upgrade a library database.
+
+Schema changes are numbered migrations. The version a database is at is
+kept in PRAGMA user_version, so running this again only applies what is
+new and never drops data:
+
+    python create_library_db.py                 # library.db, with sample data
+    python create_library_db.py --db other.db --no-seed
+    python create_library_db.py --reconcile-stats   # rebuild dashboard counters
+    python create_library_db.py --rebuild-rollups   # rebuild the analytics rollups
+    python create_library_db.py --db north.db --db south.db   # one file per branch
+"""
+import argparse
 import sqlite3
 from werkzeug.security import generate_password_hash
 
-conn = sqlite3.connect('library.db')
-cur = conn.cursor()
-
-cur.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    fullname TEXT,
-    username TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL,
-    role TEXT NOT NULL DEFAULT 'librarian' 
-)
-''')
-
-cur.execute('''
-CREATE TABLE IF NOT EXISTS students (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    fullname TEXT NOT NULL,
-    lastname TEXT, 
-    student_number TEXT UNIQUE,
-    course TEXT
-)
-''')
-try:
-    cur.execute("ALTER TABLE students ADD COLUMN lastname TEXT")
-except sqlite3.OperationalError:
-    pass 
-
-cur.execute('''
-CREATE TABLE IF NOT EXISTS books (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    title TEXT NOT NULL,
-    author TEXT,
-    available INTEGER DEFAULT 1
-)
-''')
-
-cur.execute("DROP TABLE IF EXISTS borrow_records")
-
-cur.execute('''
-CREATE TABLE IF NOT EXISTS borrow_records (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    student_id INTEGER NOT NULL, 
-    book_id INTEGER NOT NULL,
-    borrow_date TEXT NOT NULL,
-    due_date TEXT NOT NULL,
-    return_date TEXT,
-    penalty REAL DEFAULT 0,
-    FOREIGN KEY(student_id) REFERENCES students(id),
-    FOREIGN KEY(book_id) REFERENCES books(id)
-)
-''')
-
-librarian_pw = generate_password_hash("librarian123")
-
-cur.execute("INSERT OR IGNORE INTO users (fullname, username, password, role) VALUES (?, ?, ?, ?)",
-            ("Chief Librarian", "librarian", librarian_pw, "librarian"))
-
-cur.execute("INSERT OR IGNORE INTO students (fullname, lastname, student_number, course) VALUES (?, ?, ?, ?)",
-            ("Sample Student", "Student", "S2024001", "IT"))
-
-sample_books = [
-    ("The Great Gatsby", "F. Scott Fitzgerald"),
-    ("To Kill a Mockingbird", "Harper Lee"),
-    ("1984", "George Orwell"),
-    ("Pride and Prejudice", "Jane Austen"),
-    ("The Hobbit", "J.R.R. Tolkien")
+DB = 'library.db'
+
+
+def migration_base_schema(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fullname TEXT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        role TEXT NOT NULL DEFAULT 'librarian'
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS students (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fullname TEXT NOT NULL,
+        lastname TEXT,
+        student_number TEXT UNIQUE,
+        course TEXT
+    )
+    ''')
+    columns = [r[1] for r in conn.execute('PRAGMA table_info(students)')]
+    if 'lastname' not in columns:
+        conn.execute("ALTER TABLE students ADD COLUMN lastname TEXT")
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS books (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        author TEXT,
+        available INTEGER DEFAULT 1
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS borrow_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        borrow_date TEXT NOT NULL,
+        due_date TEXT NOT NULL,
+        return_date TEXT,
+        penalty REAL DEFAULT 0,
+        FOREIGN KEY(student_id) REFERENCES students(id),
+        FOREIGN KEY(book_id) REFERENCES books(id)
+    )
+    ''')
+
+
+def migration_books_fts(conn):
+    # Full-text index over title/author for /search. It is an external-content
+    # table, so the triggers below keep it in step with books and the
+    # 'rebuild' backfills rows that existed before the index did.
+    try:
+        conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title,
+            author,
+            content='books',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+        ''')
+    except sqlite3.OperationalError:
+        print("⚠️ SQLite was built without FTS5; /search will use LIKE matching.")
+        return
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+        INSERT INTO books_fts (books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END
+    ''')
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+
+def migration_secondary_indexes(conn):
+    # Every index carries the rowid, so (available) also orders by id for
+    # the keyset-paginated catalog.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_available ON books (available)')
+    # Student dashboard: open loans for one student.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_student_open ON borrow_records (student_id, return_date)')
+    # Student history, newest first.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_student_date ON borrow_records (student_id, borrow_date)')
+    # Librarian borrow record list, newest first, and date-range exports.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_borrow_date ON borrow_records (borrow_date)')
+    # Loans for one book (exports, returns by book).
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_book ON borrow_records (book_id, return_date)')
+    # Penalties page only ever looks at settled, non-zero penalties.
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_borrow_records_penalties ON borrow_records (id)
+    WHERE penalty > 0 AND return_date IS NOT NULL
+    ''')
+
+
+STATS_COUNTERS = {
+    'total_books': 'SELECT COUNT(*) FROM books',
+    'available_books': 'SELECT COUNT(*) FROM books WHERE available IS 1',
+    'total_students': 'SELECT COUNT(*) FROM students',
+    'total_borrows': 'SELECT COUNT(*) FROM borrow_records',
+    'currently_borrowed': 'SELECT COUNT(*) FROM borrow_records WHERE return_date IS NULL',
+    'returned': 'SELECT COUNT(*) FROM borrow_records WHERE return_date IS NOT NULL',
+    'outstanding_penalties': 'SELECT IFNULL(SUM(penalty), 0) FROM borrow_records',
+}
+
+
+STATS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_books_insert AFTER INSERT ON books BEGIN
+        UPDATE library_stats SET total_books = total_books + 1,
+            available_books = available_books + (new.available IS 1)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_books_delete AFTER DELETE ON books BEGIN
+        UPDATE library_stats SET total_books = total_books - 1,
+            available_books = available_books - (old.available IS 1)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_books_update AFTER UPDATE OF available ON books BEGIN
+        UPDATE library_stats SET available_books = available_books + (new.available IS 1) - (old.available IS 1)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_students_insert AFTER INSERT ON students BEGIN
+        UPDATE library_stats SET total_students = total_students + 1 WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_students_delete AFTER DELETE ON students BEGIN
+        UPDATE library_stats SET total_students = total_students - 1 WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_borrow_records_insert AFTER INSERT ON borrow_records BEGIN
+        UPDATE library_stats SET total_borrows = total_borrows + 1,
+            currently_borrowed = currently_borrowed + (new.return_date IS NULL),
+            returned = returned + (new.return_date IS NOT NULL),
+            outstanding_penalties = outstanding_penalties + IFNULL(new.penalty, 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_borrow_records_delete AFTER DELETE ON borrow_records BEGIN
+        UPDATE library_stats SET total_borrows = total_borrows - 1,
+            currently_borrowed = currently_borrowed - (old.return_date IS NULL),
+            returned = returned - (old.return_date IS NOT NULL),
+            outstanding_penalties = outstanding_penalties - IFNULL(old.penalty, 0)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS stats_borrow_records_update AFTER UPDATE OF return_date, penalty ON borrow_records BEGIN
+        UPDATE library_stats SET
+            currently_borrowed = currently_borrowed + (new.return_date IS NULL) - (old.return_date IS NULL),
+            returned = returned + (new.return_date IS NOT NULL) - (old.return_date IS NOT NULL),
+            outstanding_penalties = outstanding_penalties + IFNULL(new.penalty, 0) - IFNULL(old.penalty, 0)
+        WHERE id = 1;
+    END
+    ''',
+]
+
+
+def migration_library_stats(conn):
+    # One-row table of dashboard counters. The triggers apply the delta of
+    # every write so the dashboards never have to COUNT(*) the big tables.
+    # "x IS 1" / "x IS NULL" are always 0 or 1, even when x is NULL.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS library_stats (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_books INTEGER NOT NULL DEFAULT 0,
+        available_books INTEGER NOT NULL DEFAULT 0,
+        total_students INTEGER NOT NULL DEFAULT 0,
+        total_borrows INTEGER NOT NULL DEFAULT 0,
+        currently_borrowed INTEGER NOT NULL DEFAULT 0,
+        returned INTEGER NOT NULL DEFAULT 0,
+        outstanding_penalties REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO library_stats (id) VALUES (1)')
+    for trigger in STATS_TRIGGERS:
+        conn.execute(trigger)
+    reconcile_stats(conn)
+
+
+def reconcile_stats(conn):
+    """Recompute every counter in library_stats from the base tables."""
+    assignments = ', '.join(f'{name} = ({query})' for name, query in STATS_COUNTERS.items())
+    conn.execute(f'UPDATE library_stats SET {assignments} WHERE id = 1')
+
+
+PENALTY_LEDGER_TRIGGERS = [
+    # Returned with a penalty: the ledger row becomes (or is created as)
+    # settled at the charged amount. Returned without one: no row.
+    '''
+    CREATE TRIGGER IF NOT EXISTS penalty_ledger_settle AFTER UPDATE OF return_date, penalty ON borrow_records
+    WHEN new.return_date IS NOT NULL BEGIN
+        DELETE FROM penalty_ledger WHERE record_id = new.id AND IFNULL(new.penalty, 0) <= 0;
+        INSERT INTO penalty_ledger (record_id, student_id, book_id, days_late, amount, status, updated_at)
+        SELECT new.id, new.student_id, new.book_id,
+               MAX(IFNULL(CAST(julianday(new.return_date) - julianday(new.due_date) AS INTEGER), 0), 0),
+               new.penalty, 'settled', new.return_date
+        WHERE new.penalty > 0
+        ON CONFLICT (record_id) DO UPDATE SET
+            days_late = excluded.days_late, amount = excluded.amount,
+            status = 'settled', updated_at = excluded.updated_at;
+    END
+    ''',
+    # Reopened: drop the row; the next accrual run picks the loan up again.
+    '''
+    CREATE TRIGGER IF NOT EXISTS penalty_ledger_reopen AFTER UPDATE OF return_date ON borrow_records
+    WHEN new.return_date IS NULL AND old.return_date IS NOT NULL BEGIN
+        DELETE FROM penalty_ledger WHERE record_id = new.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS penalty_ledger_insert AFTER INSERT ON borrow_records
+    WHEN new.return_date IS NOT NULL AND new.penalty > 0 BEGIN
+        INSERT INTO penalty_ledger (record_id, student_id, book_id, days_late, amount, status, updated_at)
+        VALUES (new.id, new.student_id, new.book_id,
+                MAX(IFNULL(CAST(julianday(new.return_date) - julianday(new.due_date) AS INTEGER), 0), 0),
+                new.penalty, 'settled', new.return_date);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS penalty_ledger_delete AFTER DELETE ON borrow_records BEGIN
+        DELETE FROM penalty_ledger WHERE record_id = old.id;
+    END
+    ''',
+]
+
+
+def migration_penalty_ledger(conn):
+    # One row per penalised loan: 'accruing' rows are written by the
+    # accrual job for open overdue loans, 'settled' rows by the triggers
+    # when a loan is returned with a penalty.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS penalty_ledger (
+        record_id INTEGER PRIMARY KEY,
+        student_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        days_late INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT NOT NULL CHECK (status IN ('accruing', 'settled')),
+        updated_at TEXT NOT NULL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_penalty_ledger_status ON penalty_ledger (status)')
+    # Open loans by due date, for the accrual job's overdue range.
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_borrow_records_open_due ON borrow_records (due_date)
+    WHERE return_date IS NULL
+    ''')
+    for trigger in PENALTY_LEDGER_TRIGGERS:
+        conn.execute(trigger)
+    # The penalties page reads the ledger now.
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_penalties')
+    conn.execute('''
+    INSERT OR IGNORE INTO penalty_ledger (record_id, student_id, book_id, days_late, amount, status, updated_at)
+    SELECT id, student_id, book_id,
+           MAX(IFNULL(CAST(julianday(return_date) - julianday(due_date) AS INTEGER), 0), 0),
+           penalty, 'settled', return_date
+    FROM borrow_records WHERE penalty > 0 AND return_date IS NOT NULL
+    ''')
+
+
+def migration_catalog_version(conn):
+    # Bumped by every write to books (adds, edits, deletes, and the
+    # availability flips of borrow/return) so caches of catalog pages can
+    # key on it and never serve a page from before a change, whichever
+    # process made it.
+    conn.execute('ALTER TABLE library_stats ADD COLUMN catalog_version INTEGER NOT NULL DEFAULT 0')
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS catalog_version_{event.lower()} AFTER {event} ON books BEGIN
+            UPDATE library_stats SET catalog_version = catalog_version + 1 WHERE id = 1;
+        END
+        ''')
+
+
+def epoch_seconds(column):
+    # The dates are naive local ISO strings; strftime('%s') reads them as
+    # UTC, which keeps differences and ordering right without a timezone.
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+TIMESTAMP_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS borrow_records_ts_insert AFTER INSERT ON borrow_records BEGIN
+        UPDATE borrow_records SET borrow_ts = {epoch_seconds('new.borrow_date')},
+            due_ts = {epoch_seconds('new.due_date')}, return_ts = {epoch_seconds('new.return_date')}
+        WHERE id = new.id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS borrow_records_ts_update
+    AFTER UPDATE OF borrow_date, due_date, return_date ON borrow_records BEGIN
+        UPDATE borrow_records SET borrow_ts = {epoch_seconds('new.borrow_date')},
+            due_ts = {epoch_seconds('new.due_date')}, return_ts = {epoch_seconds('new.return_date')}
+        WHERE id = new.id;
+    END
+    ''',
+]
+
+
+def migration_timestamp_columns(conn):
+    # Integer copies of the three dates, kept in step by the triggers, so
+    # overdue checks and date windows compare integers over an index
+    # instead of parsing or string-comparing every row. The TEXT columns
+    # stay the source of truth and are what pages and exports show.
+    for column in ('borrow_ts', 'due_ts', 'return_ts'):
+        conn.execute(f'ALTER TABLE borrow_records ADD COLUMN {column} INTEGER')
+    for trigger in TIMESTAMP_TRIGGERS:
+        conn.execute(trigger)
+    # The backfill runs in the migration's single transaction, so it holds
+    # the write lock for the whole table; the pages that sort or filter on
+    # the *_ts columns need every row filled before they are served. On a
+    # large history, run this script before starting the app.
+    conn.execute(f'''
+    UPDATE borrow_records SET borrow_ts = {epoch_seconds('borrow_date')},
+        due_ts = {epoch_seconds('due_date')}, return_ts = {epoch_seconds('return_date')}
+    ''')
+    # Open loans by due time: the accrual job's overdue range.
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_borrow_records_open_due_ts ON borrow_records (due_ts)
+    WHERE return_date IS NULL
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_borrow_ts ON borrow_records (borrow_ts)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrow_records_student_ts ON borrow_records (student_id, borrow_ts)')
+    # Replaced by the integer indexes above.
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_open_due')
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_borrow_date')
+    conn.execute('DROP INDEX IF EXISTS idx_borrow_records_student_date')
+
+
+def migration_page_versions(conn):
+    # Counters the HTTP validators (ETags) are built from. history_version
+    # moves whenever one of a student's loans changes; titles_version only
+    # when a book's title or author changes or a book goes away, which is
+    # all a history page shows of the catalog (catalog_version also moves
+    # on every availability flip).
+    conn.execute('ALTER TABLE students ADD COLUMN history_version INTEGER NOT NULL DEFAULT 0')
+    conn.execute('ALTER TABLE library_stats ADD COLUMN titles_version INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS history_version_insert AFTER INSERT ON borrow_records BEGIN
+        UPDATE students SET history_version = history_version + 1 WHERE id = new.student_id;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS history_version_update
+    AFTER UPDATE OF borrow_date, due_date, return_date, penalty ON borrow_records BEGIN
+        UPDATE students SET history_version = history_version + 1 WHERE id = new.student_id;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS history_version_delete AFTER DELETE ON borrow_records BEGIN
+        UPDATE students SET history_version = history_version + 1 WHERE id = old.student_id;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS titles_version_update AFTER UPDATE OF title, author ON books BEGIN
+        UPDATE library_stats SET titles_version = titles_version + 1 WHERE id = 1;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS titles_version_delete AFTER DELETE ON books BEGIN
+        UPDATE library_stats SET titles_version = titles_version + 1 WHERE id = 1;
+    END
+    ''')
+
+
+def migration_titles_version_insert(conn):
+    # The typeahead index in each app worker lists every title, so it has
+    # to hear about new books too, not just edits and deletes.
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS titles_version_insert AFTER INSERT ON books BEGIN
+        UPDATE library_stats SET titles_version = titles_version + 1 WHERE id = 1;
+    END
+    ''')
+
+
+ROLLUP_MEASURES = ('borrows', 'returns', 'loan_seconds', 'late_returns')
+
+# Per-key circulation totals for /librarian/reports/analytics, which reads
+# only these. Days count borrows on the borrow date and returns (with
+# their loan time and lateness) on the return date; the other rollups
+# count each record once under its book, its book's author, its student
+# and its student's course.
+ROLLUP_TABLES = {
+    'circulation_by_day': ('day', 'TEXT'),
+    'circulation_by_book': ('book_id', 'INTEGER'),
+    'circulation_by_author': ('author', 'TEXT'),
+    'circulation_by_student': ('student_id', 'INTEGER'),
+    'circulation_by_course': ('course', 'TEXT'),
+}
+
+
+def rollup_upserts(row, sign):
+    """Trigger statements adding ``sign`` times borrow record ``row`` (new/old) to every rollup."""
+    returned = f'({row}.return_date IS NOT NULL)'
+    loan = f"IFNULL({epoch_seconds(row + '.return_date')} - {epoch_seconds(row + '.borrow_date')}, 0)"
+    late = f"IFNULL({epoch_seconds(row + '.return_date')} > {epoch_seconds(row + '.due_date')}, 0)"
+    add = ', '.join(f'{m} = {m} + excluded.{m}' for m in ROLLUP_MEASURES)
+    yield f'''
+        INSERT INTO circulation_by_day (day, borrows) VALUES (substr({row}.borrow_date, 1, 10), {sign})
+        ON CONFLICT (day) DO UPDATE SET borrows = borrows + excluded.borrows;'''
+    yield f'''
+        INSERT INTO circulation_by_day (day, returns, loan_seconds, late_returns)
+        SELECT substr({row}.return_date, 1, 10), {sign}, {sign} * {loan}, {sign} * {late}
+        WHERE {row}.return_date IS NOT NULL
+        ON CONFLICT (day) DO UPDATE SET returns = returns + excluded.returns,
+            loan_seconds = loan_seconds + excluded.loan_seconds, late_returns = late_returns + excluded.late_returns;'''
+    for table, key in (('circulation_by_book', f'{row}.book_id'),
+                       ('circulation_by_author', f"IFNULL((SELECT author FROM books WHERE id = {row}.book_id), '')"),
+                       ('circulation_by_student', f'{row}.student_id'),
+                       ('circulation_by_course',
+                        f"IFNULL((SELECT course FROM students WHERE id = {row}.student_id), '')")):
+        yield f'''
+        INSERT INTO {table} ({ROLLUP_TABLES[table][0]}, {', '.join(ROLLUP_MEASURES)})
+        VALUES ({key}, {sign}, {sign} * {returned}, {sign} * {loan}, {sign} * {late})
+        ON CONFLICT ({ROLLUP_TABLES[table][0]}) DO UPDATE SET {add};'''
+
+
+def move_totals(table, old_key, new_key, source, source_id):
+    """Trigger statements moving one book's or student's totals (from ``source``) between two keys of ``table``."""
+    key, measures = ROLLUP_TABLES[table][0], ', '.join(ROLLUP_MEASURES)
+    add = ', '.join(f'{m} = {m} + excluded.{m}' for m in ROLLUP_MEASURES)
+    for value, sign in ((old_key, '-1'), (new_key, '1')):
+        yield f'''
+        INSERT INTO {table} ({key}, {measures})
+        SELECT {value}, {', '.join(f'{sign} * {m}' for m in ROLLUP_MEASURES)}
+        FROM {source} WHERE {ROLLUP_TABLES[source][0]} = {source_id}
+        ON CONFLICT ({key}) DO UPDATE SET {add};'''
+
+
+ROLLUP_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_insert AFTER INSERT ON borrow_records BEGIN
+        {''.join(rollup_upserts('new', '1'))}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_delete AFTER DELETE ON borrow_records BEGIN
+        {''.join(rollup_upserts('old', '-1'))}
+    END
+    ''',
+    # A return (or any edit to what the totals depend on) takes the old
+    # row out and puts the new one in.
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_update
+    AFTER UPDATE OF student_id, book_id, borrow_date, due_date, return_date ON borrow_records BEGIN
+        {''.join(rollup_upserts('old', '-1'))}
+        {''.join(rollup_upserts('new', '1'))}
+    END
+    ''',
+    # Authors and courses are keyed by the book's and student's current
+    # values, as rebuild_rollups() does; a deleted one's totals go to ''.
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_book_author AFTER UPDATE OF author ON books
+    WHEN IFNULL(old.author, '') != IFNULL(new.author, '') BEGIN
+        {''.join(move_totals('circulation_by_author', "IFNULL(old.author, '')", "IFNULL(new.author, '')",
+                             'circulation_by_book', 'new.id'))}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_book_delete AFTER DELETE ON books
+    WHEN IFNULL(old.author, '') != '' BEGIN
+        {''.join(move_totals('circulation_by_author', 'old.author', "''", 'circulation_by_book', 'old.id'))}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_student_course AFTER UPDATE OF course ON students
+    WHEN IFNULL(old.course, '') != IFNULL(new.course, '') BEGIN
+        {''.join(move_totals('circulation_by_course', "IFNULL(old.course, '')", "IFNULL(new.course, '')",
+                             'circulation_by_student', 'new.id'))}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollups_student_delete AFTER DELETE ON students
+    WHEN IFNULL(old.course, '') != '' BEGIN
+        {''.join(move_totals('circulation_by_course', 'old.course', "''", 'circulation_by_student', 'old.id'))}
+    END
+    ''',
+]
+
+
+def migration_circulation_rollups(conn):
+    for table, (key, key_type) in ROLLUP_TABLES.items():
+        measures = ', '.join(f'{m} INTEGER NOT NULL DEFAULT 0' for m in ROLLUP_MEASURES)
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({key} {key_type} PRIMARY KEY, {measures}) WITHOUT ROWID')
+    # Top-N books, authors and borrowers.
+    for table in ('circulation_by_book', 'circulation_by_author', 'circulation_by_student'):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_borrows ON {table} (borrows)')
+    for trigger in ROLLUP_TRIGGERS:
+        conn.execute(trigger)
+    rebuild_rollups(conn)
+
+
+def rebuild_rollups(conn):
+    """Recompute every circulation rollup from borrow_records."""
+    for table in ROLLUP_TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    measures = ', '.join(ROLLUP_MEASURES)
+    totals = ('COUNT(*), SUM(return_date IS NOT NULL), SUM(IFNULL(return_ts - borrow_ts, 0)), '
+              'SUM(IFNULL(return_ts > due_ts, 0))')
+    conn.execute('''
+    INSERT INTO circulation_by_day (day, borrows)
+    SELECT substr(borrow_date, 1, 10), COUNT(*) FROM borrow_records GROUP BY 1
+    ''')
+    conn.execute('''
+    INSERT INTO circulation_by_day (day, returns, loan_seconds, late_returns)
+    SELECT substr(return_date, 1, 10), COUNT(*), SUM(IFNULL(return_ts - borrow_ts, 0)),
+           SUM(IFNULL(return_ts > due_ts, 0))
+    FROM borrow_records WHERE return_date IS NOT NULL GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET returns = excluded.returns,
+        loan_seconds = excluded.loan_seconds, late_returns = excluded.late_returns
+    ''')
+    conn.execute(f'INSERT INTO circulation_by_book (book_id, {measures}) '
+                 f'SELECT book_id, {totals} FROM borrow_records GROUP BY book_id')
+    conn.execute(f'INSERT INTO circulation_by_student (student_id, {measures}) '
+                 f'SELECT student_id, {totals} FROM borrow_records GROUP BY student_id')
+    sums = ', '.join(f'SUM(r.{m})' for m in ROLLUP_MEASURES)
+    conn.execute(f'''
+    INSERT INTO circulation_by_author (author, {measures})
+    SELECT IFNULL(b.author, ''), {sums}
+    FROM circulation_by_book r LEFT JOIN books b ON b.id = r.book_id
+    GROUP BY 1
+    ''')
+    conn.execute(f'''
+    INSERT INTO circulation_by_course (course, {measures})
+    SELECT IFNULL(s.course, ''), {sums}
+    FROM circulation_by_student r LEFT JOIN students s ON s.id = r.student_id
+    GROUP BY 1
+    ''')
+
+
+# Append new migrations to the end; a database at version N has had the
+# first N applied. Never edit or reorder one that has shipped.
+MIGRATIONS = [
+    migration_base_schema,
+    migration_books_fts,
+    migration_secondary_indexes,
+    migration_library_stats,
+    migration_penalty_ledger,
+    migration_catalog_version,
+    migration_timestamp_columns,
+    migration_page_versions,
+    migration_titles_version_insert,
+    migration_circulation_rollups,
 ]
-cur.executemany("INSERT OR IGNORE INTO books (title, author) VALUES (?, ?)", sample_books)
 
-conn.commit()
-conn.close()
-print("✅ library.db created/updated with tables and sample data.")
\ No newline at end of file
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply any pending migrations to ``conn`` and return the new version.
+
+    Each migration runs in its own IMMEDIATE transaction together with the
+    version bump, so a failure leaves the database at the last good
+    version and concurrent callers (several app workers starting at once)
+    apply every migration exactly once.
+    """
+    if schema_version(conn) >= len(MIGRATIONS):
+        return schema_version(conn)
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if schema_version(conn) < version:
+                    migration(conn)
+                    conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+    return schema_version(conn)
+
+
+def seed(conn):
+    librarian_pw = generate_password_hash("librarian123")
+
+    conn.execute("INSERT OR IGNORE INTO users (fullname, username, password, role) VALUES (?, ?, ?, ?)",
+                 ("Chief Librarian", "librarian", librarian_pw, "librarian"))
+
+    conn.execute("INSERT OR IGNORE INTO students (fullname, lastname, student_number, course) VALUES (?, ?, ?, ?)",
+                 ("Sample Student", "Student", "S2024001", "IT"))
+
+    # books has no natural key, so only seed an empty catalog.
+    if conn.execute('SELECT 1 FROM books LIMIT 1').fetchone() is None:
+        sample_books = [
+            ("The Great Gatsby", "F. Scott Fitzgerald"),
+            ("To Kill a Mockingbird", "Harper Lee"),
+            ("1984", "George Orwell"),
+            ("Pride and Prejudice", "Jane Austen"),
+            ("The Hobbit", "J.R.R. Tolkien")
+        ]
+        conn.executemany("INSERT INTO books (title, author) VALUES (?, ?)", sample_books)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', action='append',
+                        help=f'database file; repeat for each branch (default: {DB})')
+    parser.add_argument('--no-seed', action='store_true', help='do not add the sample librarian, student and books')
+    parser.add_argument('--reconcile-stats', action='store_true',
+                        help='rebuild the dashboard counters in library_stats from scratch')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help='recompute the circulation rollups behind the analytics report')
+    args = parser.parse_args()
+
+    for path in args.db or [DB]:
+        conn = sqlite3.connect(path)
+        before = schema_version(conn)
+        after = migrate(conn)
+        if not args.no_seed:
+            seed(conn)
+        print(f"✅ {path} migrated from schema version {before} to {after}.")
+        if args.reconcile_stats:
+            with conn:
+                reconcile_stats(conn)
+            print(f"✅ {path}: library_stats counters rebuilt.")
+        if args.rebuild_rollups:
+            with conn:
+                rebuild_rollups(conn)
+            print(f"✅ {path}: circulation rollups rebuilt.")
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
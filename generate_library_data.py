@@ -0,0 +1,163 @@
+"""Generate a synthetic library database for benchmarking.
+
+Builds a fresh database with the current migrations, the sample
+librarian (librarian / librarian123) and student, and then a catalog,
+a roster and a borrow history of the requested sizes. The same --seed
+always produces the same data:
+
+    python generate_library_data.py --db bench.db                    # small
+    python generate_library_data.py --db big.db --books 1000000 \\
+        --students 100000 --records 10000000
+
+Borrow dates are spread over --years of history. A --open-rate share of
+loans is still out (each on a distinct copy), a --late-rate share of the
+returned ones came back after the due date and carries the penalty the
+app would have charged.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import create_library_db
+
+TITLE_WORDS = [
+    'Silent', 'River', 'Garden', 'Empire', 'Shadow', 'Light', 'Island', 'Journey', 'Secret', 'Winter',
+    'Mountain', 'Ocean', 'Letters', 'History', 'Principles', 'Introduction', 'Modern', 'Ancient', 'Night',
+    'City', 'House', 'Song', 'Story', 'Science', 'Art', 'Mathematics', 'Philippine', 'Hidden', 'Last',
+    'First', 'Golden', 'Broken', 'Forgotten', 'Storm', 'Fire', 'Stone', 'Theory', 'Practice', 'Life',
+    'Dreams', 'Kingdom', 'Voyage', 'Harvest', 'Memory', 'Mirror', 'Bridge', 'Machine', 'Field', 'Sky',
+]
+FIRST_NAMES = [
+    'Maria', 'Jose', 'Juan', 'Ana', 'Mark', 'Angel', 'John', 'Grace', 'Paolo', 'Kristine', 'Miguel',
+    'Andrea', 'Carlo', 'Patricia', 'Joshua', 'Camille', 'Rafael', 'Bea', 'Gabriel', 'Nicole', 'Luis',
+    'Sofia', 'Daniel', 'Isabel', 'Ramon', 'Teresa', 'Emilio', 'Lourdes', 'Andres', 'Carmen',
+]
+LAST_NAMES = [
+    'Santos', 'Reyes', 'Cruz', 'Bautista', 'Ocampo', 'Garcia', 'Mendoza', 'Torres', 'Tomas', 'Andrada',
+    'Castillo', 'Flores', 'Villanueva', 'Ramos', 'Castro', 'Rivera', 'Aquino', 'Navarro', 'Salazar',
+    'Mercado', 'Dela Cruz', 'Gonzales', 'Lopez', 'Rizal', 'Mabini', 'Bonifacio', 'Luna', 'Silang',
+]
+COURSES = ['IT', 'CS', 'BSED', 'BSA', 'BSN', 'BSBA', 'ABCOMM', 'BSCE', 'BSEE', 'BSPSY']
+
+
+def chunks(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def books(rng, count):
+    for _ in range(count):
+        title = ' '.join(rng.sample(TITLE_WORDS, rng.randint(2, 4)))
+        author = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        yield (title, author)
+
+
+def students(rng, count):
+    for i in range(count):
+        last = rng.choice(LAST_NAMES)
+        fullname = f'{rng.choice(FIRST_NAMES)} {last}'
+        yield (fullname, fullname.split()[-1], f'G{i:07d}', rng.choice(COURSES))
+
+
+def borrow_records(rng, count, book_ids, student_ids, args, now):
+    """Yield (student_id, book_id, borrow_date, due_date, return_date, penalty)."""
+    history = timedelta(days=365 * args.years)
+    loan = timedelta(days=args.loan_days)
+    open_loans = min(int(count * args.open_rate), len(book_ids))
+    open_books = rng.sample(book_ids, open_loans)
+    for i in range(count):
+        student_id = rng.choice(student_ids)
+        if i < open_loans:
+            # Still out: borrowed recently enough that some are overdue.
+            borrowed = now - timedelta(seconds=rng.randrange(int(loan.total_seconds() * 3)))
+            due = borrowed + loan
+            yield (student_id, open_books[i], borrowed.isoformat(timespec='seconds'),
+                   due.isoformat(timespec='seconds'), None, 0)
+            continue
+        borrowed = now - timedelta(seconds=rng.randrange(int(history.total_seconds())))
+        due = borrowed + loan
+        if rng.random() < args.late_rate:
+            returned = due + timedelta(seconds=rng.randrange(1, 30 * 86400))
+        else:
+            returned = borrowed + timedelta(seconds=rng.randrange(3600, int(loan.total_seconds())))
+        days_late = (returned - due).days if returned > due else 0
+        yield (student_id, rng.choice(book_ids), borrowed.isoformat(timespec='seconds'),
+               due.isoformat(timespec='seconds'), returned.isoformat(timespec='seconds'),
+               days_late * args.penalty_per_day)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='library_bench.db')
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--years', type=float, default=4)
+    parser.add_argument('--open-rate', type=float, default=0.02, help='share of loans still out')
+    parser.add_argument('--late-rate', type=float, default=0.15, help='share of returns after the due date')
+    parser.add_argument('--loan-days', type=int, default=7)
+    parser.add_argument('--penalty-per-day', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=2024)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--force', action='store_true', help='overwrite --db if it exists')
+    args = parser.parse_args()
+
+    if os.path.exists(args.db):
+        if not args.force:
+            parser.error(f'{args.db} exists; pass --force to overwrite it')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    rng = random.Random(args.seed)
+    # Fixed "now" so the same seed gives the same file.
+    now = datetime(2025, 6, 1, 12, 0, 0)
+    started = time.monotonic()
+    conn = sqlite3.connect(args.db)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -262144')
+    create_library_db.migrate(conn)
+    create_library_db.seed(conn)
+
+    def load(label, sql, rows):
+        t = time.monotonic()
+        n = 0
+        for batch in chunks(rows, args.batch_size):
+            with conn:
+                conn.executemany(sql, batch)
+            n += len(batch)
+        print(f'  {label}: {n} rows in {time.monotonic() - t:.1f}s')
+
+    load('books', 'INSERT INTO books (title, author) VALUES (?, ?)', books(rng, args.books))
+    load('students', 'INSERT INTO students (fullname, lastname, student_number, course) VALUES (?, ?, ?, ?)',
+         students(rng, args.students))
+    book_ids = [r[0] for r in conn.execute('SELECT id FROM books')]
+    student_ids = [r[0] for r in conn.execute('SELECT id FROM students')]
+    load('borrow_records',
+         'INSERT INTO borrow_records (student_id, book_id, borrow_date, due_date, return_date, penalty) '
+         'VALUES (?, ?, ?, ?, ?, ?)',
+         borrow_records(rng, args.records, book_ids, student_ids, args, now))
+    with conn:
+        conn.execute('''
+            UPDATE books SET available = 0
+            WHERE id IN (SELECT book_id FROM borrow_records WHERE return_date IS NULL)
+        ''')
+    conn.execute('ANALYZE')
+    conn.close()
+    print(f'✅ {args.db} generated in {time.monotonic() - started:.1f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+"""Stress the borrow/return engine from several processes at once.
+
+Each process plays a circulation desk: it keeps lending random books to
+random students and returning some of its open loans, using the same
+run_transaction()/checkout_book()/checkin_record() path as the routes.
+Afterwards the database is checked for double loans and for books whose
+availability disagrees with their open loans:
+
+    python stress_circulation.py --processes 8 --seconds 10
+    python stress_circulation.py --books 20 --busy-timeout-ms 1   # force retries
+    python stress_circulation.py --batch 100   # desks post scans to /api/kiosk/circulation
+    python stress_circulation.py --branches 4  # desks spread over one database per branch
+
+Each branch is its own SQLite file with its own write lock, so checkouts
+per second should grow with --branches until the disk or CPU saturates.
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import create_library_db
+
+
+def build_database(path, books, students):
+    conn = sqlite3.connect(path)
+    # Switch to WAL and migrate before any desk starts, so no desk's first
+    # connection has to take the write lock for either.
+    conn.execute('PRAGMA journal_mode = WAL')
+    create_library_db.migrate(conn)
+    conn.executemany('INSERT INTO books (title, author) VALUES (?, ?)',
+                     ((f'Stress Title {i}', f'Author {i % 97}') for i in range(books)))
+    conn.executemany('INSERT INTO students (fullname, lastname, student_number, course) VALUES (?, ?, ?, ?)',
+                     ((f'Student {i}', f'{i}', f'ST{i:06d}', 'IT') for i in range(students)))
+    conn.commit()
+    conn.close()
+
+
+def kiosk_desk(library_app, rng, deadline, batch, book_ids, student_numbers, counts):
+    """Post batches of scans to the kiosk API, the way a barcode desk would."""
+    library_app.app.config['KIOSK_TOKENS'] = {'stress-token': 'stress'}
+    client = library_app.app.test_client()
+    headers = {'Authorization': 'Bearer stress-token'}
+    out = set()
+    while time.monotonic() < deadline:
+        items = []
+        for _ in range(batch):
+            if out and rng.random() < 0.4:
+                items.append({'action': 'return', 'book_id': out.pop()})
+            else:
+                items.append({'action': 'checkout', 'book_id': rng.choice(book_ids),
+                              'student_number': rng.choice(student_numbers)})
+        response = client.post('/api/kiosk/circulation', json={'items': items}, headers=headers)
+        if response.status_code == 503:
+            counts['busy'] += 1
+            continue
+        if response.status_code != 200:
+            raise RuntimeError(f'kiosk batch failed: {response.status_code} {response.data[:200]!r}')
+        for item, result in zip(items, response.get_json()['results']):
+            if item['action'] == 'return':
+                counts['returns'] += result['ok']
+            elif result['ok']:
+                out.add(item['book_id'])
+                counts['checkouts'] += 1
+            else:
+                counts['unavailable'] += 1
+
+
+def desk(path, seconds, seed, busy_timeout_ms, batch, results):
+    import app as library_app
+    library_app.DB = path
+    library_app.app.config['DB_BUSY_TIMEOUT_MS'] = busy_timeout_ms
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    book_ids = [r[0] for r in conn.execute('SELECT id FROM books')]
+    student_ids = [r[0] for r in conn.execute('SELECT id FROM students')]
+    student_numbers = [r[0] for r in conn.execute('SELECT student_number FROM students')]
+    conn.close()
+
+    open_loans = []
+    counts = {'checkouts': 0, 'unavailable': 0, 'returns': 0, 'busy': 0}
+    deadline = time.monotonic() + seconds
+    if batch:
+        kiosk_desk(library_app, rng, deadline, batch, book_ids, student_numbers, counts)
+        results.put(counts)
+        return
+    while time.monotonic() < deadline:
+        conn = None
+        try:
+            conn = library_app.get_db_connection()
+            if open_loans and rng.random() < 0.4:
+                record_id = open_loans.pop(rng.randrange(len(open_loans)))
+                library_app.run_transaction(conn, lambda c: library_app.checkin_record(c, record_id))
+                counts['returns'] += 1
+            else:
+                student_id, book_id = rng.choice(student_ids), rng.choice(book_ids)
+                record_id, _, _ = library_app.run_transaction(
+                    conn, lambda c: library_app.checkout_book(c, student_id, book_id))
+                open_loans.append(record_id)
+                counts['checkouts'] += 1
+        except library_app.CirculationError:
+            counts['unavailable'] += 1
+        except sqlite3.OperationalError as exc:
+            if not library_app.is_busy_error(exc):
+                raise
+            counts['busy'] += 1
+        finally:
+            if conn is not None:
+                conn.close()
+    results.put(counts)
+
+
+def verify(path):
+    conn = sqlite3.connect(path)
+    problems = []
+    for book_id, loans in conn.execute('''
+        SELECT book_id, COUNT(*) FROM borrow_records WHERE return_date IS NULL
+        GROUP BY book_id HAVING COUNT(*) > 1
+    '''):
+        problems.append(f'book {book_id} is out on {loans} loans at once')
+    for book_id, available in conn.execute('''
+        SELECT b.id, b.available FROM books b
+        WHERE b.available != (NOT EXISTS (SELECT 1 FROM borrow_records br
+                                          WHERE br.book_id = b.id AND br.return_date IS NULL))
+    '''):
+        problems.append(f'book {book_id} has available={available} but disagrees with its open loans')
+    stats = conn.execute('SELECT * FROM library_stats').fetchone()
+    create_library_db.reconcile_stats(conn)
+    if stats != conn.execute('SELECT * FROM library_stats').fetchone():
+        problems.append('library_stats drifted from the base tables')
+    conn.rollback()
+    conn.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--books', type=int, default=200)
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--busy-timeout-ms', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=0,
+                        help='scans per kiosk API request; 0 calls the circulation helpers one item at a time')
+    parser.add_argument('--branches', type=int, default=1,
+                        help='databases to spread the desks over, round-robin')
+    parser.add_argument('--db', help='database to create (default: a temporary file)')
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'stress.db')
+    paths = [path] + [f'{os.path.splitext(path)[0]}-{n}.db' for n in range(1, args.branches)]
+    for branch_path in paths:
+        build_database(branch_path, args.books, args.students)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    desks = [ctx.Process(target=desk, args=(paths[seed % len(paths)], args.seconds, seed,
+                                            args.busy_timeout_ms, args.batch, results))
+             for seed in range(args.processes)]
+    started = time.monotonic()
+    for p in desks:
+        p.start()
+    for p in desks:
+        p.join()
+    elapsed = time.monotonic() - started
+    crashed = sum(p.exitcode != 0 for p in desks)
+    totals = {'checkouts': 0, 'unavailable': 0, 'returns': 0, 'busy': 0}
+    for _ in range(len(desks) - crashed):
+        for key, value in results.get().items():
+            totals[key] += value
+
+    print(f"{args.processes} processes, {len(paths)} branch(es), {elapsed:.1f}s, {args.books} books per branch")
+    print(f"checkouts: {totals['checkouts']} ({totals['checkouts'] / elapsed:.0f}/s)  "
+          f"returns: {totals['returns']}  not available: {totals['unavailable']}  "
+          f"gave up busy: {totals['busy']}")
+    problems = [f'{os.path.basename(p)}: {problem}' if len(paths) > 1 else problem
+                for p in paths for problem in verify(p)]
+    if crashed:
+        problems.append(f'{crashed} desk processes crashed')
+    for problem in problems:
+        print(f'❌ {problem}')
+    if not problems:
+        print('✅ no double loans; book availability matches open loans.')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())